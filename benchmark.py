@@ -1,3 +1,5 @@
+import os
+import sys
 import time
 
 import msgspec
@@ -20,11 +22,36 @@ class Book(msgspec.Struct):
 
 AUTHORS = 100
 BOOKS = 5
+NS_IN_MS = 1_000_000
+
+if sys.argv[1:] == ['compression']:
+    # Write throughput vs archive size of ZIP storage compressions
+    COMPRESSION_BOOKS = 10_000
+    for compression, levels in (('stored', (None,)), ('deflate', (1, 6, 9)), ('bzip2', (1, 9)), ('lzma', (None,))):
+        for level in levels:
+            s = pys.zip_storage('benchmark.zip', compression=compression, compresslevel=level)
+            start = time.time_ns()
+            with s.session():
+                for i in range(0, COMPRESSION_BOOKS):
+                    s.save(Book(id=str(i), title=f'Book {i} ' * 10, author_id=str(i % AUTHORS)))
+            t1 = time.time_ns() - start
+            start = time.time_ns()
+            assert len(list(s.list(Book))) == COMPRESSION_BOOKS
+            t2 = time.time_ns() - start
+            print(f'Storage: {s}')
+            print(f'Save {COMPRESSION_BOOKS} objects: {t1/NS_IN_MS:.2f} ms -- '
+                  f'{COMPRESSION_BOOKS/(t1/NS_IN_MS/1000):.0f} objects per second -- '
+                  f'archive {os.path.getsize("benchmark.zip")/1024:.0f} KB -- '
+                  f'list {t2/NS_IN_MS/COMPRESSION_BOOKS:.3f} ms per object')
+            s.destroy()
+    sys.exit()
 
 storages = (
     pys.file_storage('benchmark.storage'),
     pys.sqlite_storage('benchmark.db'),
     pys.zip_storage('benchmark.zip'),
+    pys.log_storage('benchmark.log'),
+    pys.dbm_storage('benchmark.dbm'),
 )
 for s in storages:
     start = time.time_ns()
@@ -61,13 +88,21 @@ for s in storages:
     t4 = end - start
     total4 = len(books)
 
-    NS_IN_MS = 1_000_000
+    start = time.time_ns()
+    for author in authors_found:
+        assert s.load(Author, author.id) is not None
+        for j in range(0, BOOKS):
+            assert s.load(Book, str(int(author.id)*AUTHORS + j), author) is not None
+    end = time.time_ns()
+    t5 = end - start
+    total5 = AUTHORS + AUTHORS * BOOKS
 
     print(f'Storage: {s}')
     print(f'T1: {t1/NS_IN_MS:.2f} ms -- save {total1} objects -- {t1/NS_IN_MS/total1:.3f} ms per object')
     # print(f'T2: {t2/NS_IN_MS:.2f} ms -- list {total2} objects -- {t2/1000000/total2:.6f} mks per object')
     print(f'T3: {t3/NS_IN_MS:.2f} ms -- list {total3} objects -- {t3/NS_IN_MS/total3:.3f} ms per object')
     print(f'T4: {t4/NS_IN_MS:.2f} ms -- list {total4} objects -- {t4/NS_IN_MS/total4:.3f} ms per object')
+    print(f'T5: {t5/NS_IN_MS:.2f} ms -- load {total5} objects -- {t5/NS_IN_MS/total5:.3f} ms per object')
 
     s.destroy()
 
@@ -3,9 +3,13 @@ import functools
 import uuid
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Union, Callable, Any
+from typing import Union, Callable, Any, List, Sequence, Iterable, Tuple
 
-from . import file, sqlite, zipfile
+from . import dbm, file, log, sqlite, zipfile
+from .aio import AsyncStorage
+from .base import BaseStorage
+from .cache import CachedStorage
+from .parallel import ParallelLoader
 
 
 def _random_uuid(_) -> str:
@@ -33,6 +37,53 @@ def _is_msgspec_struct(cls):
         return False
 
 
+@functools.lru_cache(maxsize=None)
+def _json_encoder():
+    import msgspec
+    return msgspec.json.Encoder()
+
+
+def _class_cached(cls, name: str, build: Callable[[], Any]) -> Any:
+    """
+    Get value cached in the own `name` attribute of the class, build it on the first use.
+    """
+    try:
+        return cls.__dict__[name]
+    except KeyError:
+        value = build()
+        setattr(cls, name, value)
+        return value
+
+
+def _typed_decoder(target):
+    import msgspec
+    try:
+        return msgspec.json.Decoder(target)
+    except Exception:
+        # Annotations not supported by msgspec (or not resolvable), decode untyped
+        return None
+
+
+def _json_decoder(cls):
+    """
+    Get typed JSON decoder cached for the class or None if the class can not be decoded by type.
+    """
+    return _class_cached(cls, '__pys_decoder__', lambda: _typed_decoder(cls))
+
+
+def _json_list_decoder(cls):
+    """
+    Get typed JSON decoder of a list of class instances or None if the class can not be decoded by type.
+    """
+    return _class_cached(cls, '__pys_list_decoder__', lambda: _typed_decoder(List[cls]))
+
+
+def _json_array(raw_contents: Sequence[Union[str, bytes]]) -> Union[str, bytes]:
+    if raw_contents and isinstance(raw_contents[0], str):
+        return f'[{",".join(raw_contents)}]'
+    return b'[' + b','.join(raw_contents) + b']'
+
+
 class Persistent(abc.ABC):
     """
     Base class for any object ready to be persisted
@@ -47,6 +98,16 @@ class Persistent(abc.ABC):
         """
         raise NotImplementedError
 
+    @classmethod
+    def __factory_many__(cls, raw_contents: Sequence[str], model_ids: Sequence[Any]) -> List['Persistent']:
+        """
+        Create objects of class from `raw_contents` with IDs from `model_ids`
+        :param raw_contents: Raw contents
+        :param model_ids: Model IDs
+        :return: Instances of class in the same order
+        """
+        return [cls.__factory__(raw_content, model_id) for raw_content, model_id in zip(raw_contents, model_ids)]
+
     def __json__(self) -> str:
         """
         Get JSON representation of the object
@@ -54,26 +115,43 @@ class Persistent(abc.ABC):
         """
         raise NotImplementedError
 
+    # Classes may also implement `__json_bytes__()` returning JSON as UTF-8 bytes, then storages
+    # pass raw content to `__factory__()` and `__factory_many__()` as bytes without transcoding.
+
+
+def _normalize_indexes(indexes: Iterable[Union[str, Tuple[str, ...]]]) -> Tuple[Tuple[str, ...], ...]:
+    normalized = tuple((index,) if isinstance(index, str) else tuple(index) for index in indexes)
+    for index in normalized:
+        if not index or not all(field.isidentifier() for field in index):
+            raise ValueError(f'Index {index} shall be a field name or a tuple of field names')
+    return normalized
+
 
 def saveable(base_cls=None, *,
              field_as_id: str = 'id',
-             default_id: Callable[[Any], str] = _random_uuid):
+             default_id: Callable[[Any], str] = _random_uuid,
+             indexes: Iterable[Union[str, Tuple[str, ...]]] = ()):
     """
     Decorate the given `cls` with `__my_id__()` and `__json__()` methods
     required for persistence.
     :param base_cls: Class to decorate.
     :param field_as_id: existing class field to be used as object ID.
     :param default_id: Default ID value function (id(self) by default).
+    :param indexes: Fields (or tuples of fields) to be indexed by storages for `find_by()`.
     :return: Decorated class
     """
     if not base_cls:
         def wrapper(decor_cls):
-            return saveable(decor_cls, field_as_id=field_as_id)
+            return saveable(decor_cls, field_as_id=field_as_id, default_id=default_id, indexes=indexes)
 
         return wrapper
 
+    model_indexes = _normalize_indexes(indexes)
+
     @functools.wraps(base_cls, updated=())
     class _BasePersistence(base_cls):
+        __pys_indexes__ = model_indexes
+
         @classmethod
         def __factory__(cls, raw_content: str, model_id: Any) -> base_cls:
             if hasattr(base_cls, '__factory__'):
@@ -83,6 +161,12 @@ def saveable(base_cls=None, *,
                     f'The class {base_cls} is not msgspec.Struct, @dataclass nor Pydantic Model '
                     f'and does not have __factory__() method. Please implement __factory__() method by yourself.')
 
+        @classmethod
+        def __factory_many__(cls, raw_contents: Sequence[str], model_ids: Sequence[Any]) -> List[base_cls]:
+            if hasattr(base_cls, '__factory_many__'):
+                return base_cls.__factory_many__(raw_contents, model_ids)
+            return [cls.__factory__(raw_content, model_id) for raw_content, model_id in zip(raw_contents, model_ids)]
+
         @staticmethod
         def _valid_id(_id: Any) -> Any:
             if not _id:
@@ -127,19 +211,23 @@ def saveable(base_cls=None, *,
 
     @functools.wraps(base_cls, updated=())
     class _NoIdField(_BasePersistence):
-        @classmethod
-        def _parent_factory(cls) -> Callable[[str, Any], _BasePersistence]:
-            raise NotImplementedError
-
         def set_saved_id(self, model_id: Any):
             self.__my_saved_id__ = model_id
 
         @classmethod
         def __factory__(cls, raw_content: str, model_id: str) -> '_NoIdField':
-            model = cls._parent_factory()(raw_content, model_id)
+            # Goes to the factory of the serialization class following in MRO
+            model = super().__factory__(raw_content, model_id)
             model.set_saved_id(model_id)
             return model
 
+        @classmethod
+        def __factory_many__(cls, raw_contents: Sequence[str], model_ids: Sequence[Any]) -> List['_NoIdField']:
+            models = super().__factory_many__(raw_contents, model_ids)
+            for model, model_id in zip(models, model_ids):
+                model.set_saved_id(model_id)
+            return models
+
         def __my_id__(self) -> str:
             if original_id := self._original_id():
                 return original_id
@@ -157,40 +245,65 @@ def saveable(base_cls=None, *,
         @functools.wraps(base_cls, updated=())
         class _Pydantic(parent):
             @classmethod
-            def __factory__(cls, raw_content: str, model_id: Any) -> '_Pydantic':
+            def __factory__(cls, raw_content: Union[str, bytes], model_id: Any) -> '_Pydantic':
                 return cls.model_validate_json(raw_content)
 
+            @classmethod
+            def __factory_many__(cls, raw_contents: Sequence[str], model_ids: Sequence[Any]) -> List['_Pydantic']:
+                from pydantic import TypeAdapter
+                adapter = _class_cached(cls, '__pys_list_adapter__', lambda: TypeAdapter(List[cls]))
+                return adapter.validate_json(_json_array(raw_contents))
+
             def __json__(self) -> str:
                 return self.model_dump_json()
 
+            def __json_bytes__(self) -> bytes:
+                return self.__pydantic_serializer__.to_json(self)
+
         @functools.wraps(base_cls, updated=())
-        class _PydanticNoId(_Pydantic, _NoIdField):
+        class _PydanticNoId(_NoIdField, _Pydantic):
             # __slots__ = (MY_SAVED_ID,)
             __my_saved_id__ = None
 
-            @classmethod
-            def _parent_factory(cls) -> Callable[[str, Any], _Pydantic]:
-                return _Pydantic.factory
-
         return _Pydantic if has_id or has_my_id else _PydanticNoId
 
     @functools.wraps(base_cls, updated=())
     class _MsgspecStruct(parent):
+        # msgspec decodes memoryview without copying it to bytes
+        __pys_buffers__ = True
+
         @classmethod
-        def __factory__(cls, raw_content: str, model_id: Any) -> '_MsgspecStruct':
+        def __factory__(cls, raw_content: Union[str, bytes], model_id: Any) -> '_MsgspecStruct':
             import msgspec
+            decoder = _json_decoder(cls)
+            if decoder is not None:
+                try:
+                    return decoder.decode(raw_content)
+                except msgspec.ValidationError:
+                    # Content does not match annotations strictly, let the class constructor handle it
+                    pass
             content = msgspec.json.decode(raw_content)
             return cls(**content)
 
-        def _prepare(self) -> dict:
-            return self
+        @classmethod
+        def __factory_many__(cls, raw_contents: Sequence[str], model_ids: Sequence[Any]) -> List['_MsgspecStruct']:
+            import msgspec
+            decoder = _json_list_decoder(cls)
+            if decoder is not None:
+                try:
+                    return decoder.decode(_json_array(raw_contents))
+                except msgspec.ValidationError:
+                    pass
+            return [cls.__factory__(raw_content, model_id) for raw_content, model_id in zip(raw_contents, model_ids)]
 
         def __json__(self) -> str:
-            import msgspec
-            return msgspec.json.encode(self._prepare()).decode(encoding='UTF-8')
+            return self.__json_bytes__().decode(encoding='UTF-8')
+
+        def __json_bytes__(self) -> bytes:
+            return _json_encoder().encode(self)
 
     @functools.wraps(base_cls, updated=())
-    class _MsgspecStructNoIdField(_MsgspecStruct, _NoIdField):
+    class _MsgspecStructNoIdField(_NoIdField, _MsgspecStruct):
         import msgspec
         __my_saved_id__: Union[str, None, msgspec.UnsetType] = msgspec.UNSET
 
@@ -211,53 +324,65 @@ def saveable(base_cls=None, *,
             else:
                 return super().__eq__(other)
 
-        @classmethod
-        def _parent_factory(cls) -> Callable[[str, Any], _MsgspecStruct]:
-            return _MsgspecStruct.factory
-
         def __json__(self) -> str:
             with self.without_saved_id():
                 return super().__json__()
 
+        def __json_bytes__(self) -> bytes:
+            with self.without_saved_id():
+                return super().__json_bytes__()
+
     if _is_msgspec_struct(base_cls):
         return _MsgspecStruct if has_id or has_my_id else _MsgspecStructNoIdField
 
     if _is_dataclass(base_cls):
         has_id = field_as_id in base_cls.__annotations__
-        from dataclasses import asdict
 
         @functools.wraps(base_cls, updated=())
         class _Dataclass(_MsgspecStruct):
-            def _prepare(self) -> dict:
-                # noinspection PyDataclass
-                return asdict(self)
+            # msgspec encodes and decodes dataclasses natively
+            pass
 
         @functools.wraps(base_cls, updated=())
-        class _DataclassNoId(_Dataclass, _NoIdField):
+        class _DataclassNoId(_NoIdField, _Dataclass):
             # __slots__ = ('__my_saved_id__',)
             __my_saved_id__ = None
 
-            @classmethod
-            def _parent_factory(cls) -> Callable[[str, Any], _Dataclass]:
-                return _Dataclass.factory
-
         return _Dataclass if has_id or has_my_id else _DataclassNoId
 
     return _HasMyIdMethod if has_my_id else _BasePersistence
 
 
-def file_storage(base_path: Union[str, Path]):
-    return file.Storage(base_path)
+def file_storage(base_path: Union[str, Path], **kwargs):
+    return file.Storage(base_path, **kwargs)
+
+
+def sqlite_storage(base_path: Union[str, Path], **kwargs):
+    return sqlite.Storage(base_path, **kwargs)
+
+
+def zip_storage(base_path: Union[str, Path], **kwargs):
+    return zipfile.Storage(base_path, **kwargs)
+
+
+def log_storage(base_path: Union[str, Path], **kwargs):
+    return log.Storage(base_path, **kwargs)
+
+
+def dbm_storage(base_path: Union[str, Path], **kwargs):
+    return dbm.Storage(base_path, **kwargs)
 
 
-def sqlite_storage(base_path: Union[str, Path]):
-    return sqlite.Storage(base_path)
+def cached_storage(inner: BaseStorage, **kwargs):
+    return CachedStorage(inner, **kwargs)
 
 
-def zip_storage(base_path: Union[str, Path]):
-    return zipfile.Storage(base_path)
+def async_storage(inner: BaseStorage, **kwargs):
+    return AsyncStorage(inner, **kwargs)
 
 
 storage = sqlite_storage
 
-__all__ = ('saveable', 'storage', 'file_storage', 'sqlite_storage', 'zip_storage', 'Persistent')
+__all__ = ('saveable', 'storage', 'file_storage', 'sqlite_storage', 'zip_storage', 'log_storage', 'dbm_storage',
+           'cached_storage', 'CachedStorage', 'async_storage', 'AsyncStorage',
+           'ParallelLoader', 'Persistent')
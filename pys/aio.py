@@ -0,0 +1,133 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor, Executor
+from typing import Type, Any, Optional, Iterable, List, AsyncIterator, Dict, Hashable, Callable, TypeVar
+
+from . import sqlite
+from .base import BaseStorage, StoredModel, Related, class_key
+
+Result = TypeVar('Result')
+
+
+class AsyncStorage:
+    """
+    asyncio facade of any storage: blocking operations run on a bounded thread pool, so they do not block
+    the event loop. Concurrent loads of the same model are coalesced into one load and share the loaded model.
+    Writes of SQLite storage go through one dedicated writer thread.
+    """
+    def __init__(self, inner: BaseStorage,
+                 max_workers: int = 8,
+                 dedicated_writer: Optional[bool] = None) -> None:
+        """
+        Run operations of the inner storage in threads.
+        :param inner: Storage to run, SQLite storage shall be created with `thread_safe=True`.
+        :param max_workers: Maximum number of operations running at once.
+        :param dedicated_writer: Run writes in one dedicated thread, None to use it for SQLite storage.
+        """
+        storage = getattr(inner, 'inner', inner)
+        is_sqlite = isinstance(storage, sqlite.Storage)
+        if is_sqlite and not storage.thread_safe:
+            raise ValueError('SQLite storage shall be created with thread_safe=True to be used from threads')
+        self.inner = inner
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pys-async')
+        self._writer: Executor = self._executor
+        if dedicated_writer or (dedicated_writer is None and is_sqlite):
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pys-async-writer')
+        # Loads in progress by model key
+        self._loading: Dict[Hashable, asyncio.Future] = {}
+
+    async def _run(self, executor: Executor, fn: Callable[..., Result], *args: Any, **kwargs: Any) -> Result:
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+    async def _write(self, fn: Callable[..., Result], *args: Any) -> Result:
+        # A load started before the write may return the old model, later loads do not join it
+        self._loading.clear()
+        try:
+            return await self._run(self._writer, fn, *args)
+        finally:
+            self._loading.clear()
+
+    async def load(self, model_class: Type[StoredModel], model_id: Any,
+                   *related_model: Related) -> Optional[StoredModel]:
+        key = model_class, class_key(model_class, *related_model), str(model_id)
+        future = self._loading.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._run(self._executor, self.inner.load, model_class, model_id,
+                                                     *related_model))
+            self._loading[key] = future
+            future.add_done_callback(lambda done: self._loading.pop(key, None) if self._loading.get(key) is done
+                                     else None)
+        # Shielded, so a cancelled caller does not cancel the load of others
+        return await asyncio.shield(future)
+
+    async def save(self, model: StoredModel, *related_model: Related) -> Any:
+        return await self._write(self.inner.save, model, *related_model)
+
+    async def delete(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> None:
+        await self._write(self.inner.delete, model_class, model_id, *related_model)
+
+    async def save_many(self, models: Iterable[StoredModel], *related_model: Related) -> List[Any]:
+        return await self._write(self.inner.save_many, list(models), *related_model)
+
+    async def load_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                        *related_model: Related) -> List[Optional[StoredModel]]:
+        return await self._run(self._executor, self.inner.load_many, model_class, list(model_ids), *related_model)
+
+    async def delete_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                          *related_model: Related) -> None:
+        await self._write(self.inner.delete_many, model_class, list(model_ids), *related_model)
+
+    async def list(self, model_class: Type[StoredModel],
+                   *related_model: Related,
+                   limit: Optional[int] = None,
+                   after: Optional[str] = None) -> AsyncIterator[StoredModel]:
+        """
+        List models ordered by ID, they are loaded in threads by pages of `decode_batch_size` while iterating.
+        Each page is listed by one call, so iterators (and cursors of SQLite) are not shared by threads.
+        """
+        page_size = getattr(self.inner, 'decode_batch_size', BaseStorage.decode_batch_size)
+        while limit is None or limit > 0:
+            size = page_size if limit is None else min(page_size, limit)
+            page = await self._run(self._executor, lambda: list(self.inner.list(model_class, *related_model,
+                                                                                limit=size, after=after)))
+            for model in page:
+                yield model
+            if len(page) < size:
+                return
+            if limit is not None:
+                limit -= len(page)
+            after = self.inner.cursor(page[-1])
+
+    async def list_ids(self, model_class: Type[StoredModel],
+                       *related_model: Related,
+                       limit: Optional[int] = None,
+                       after: Optional[str] = None) -> List[Any]:
+        return await self._run(self._executor, lambda: list(self.inner.list_ids(model_class, *related_model,
+                                                                                limit=limit, after=after)))
+
+    async def count(self, model_class: Type[StoredModel], *related_model: Related) -> int:
+        return await self._run(self._executor, self.inner.count, model_class, *related_model)
+
+    async def exists(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> bool:
+        return await self._run(self._executor, self.inner.exists, model_class, model_id, *related_model)
+
+    def cursor(self, model: StoredModel) -> str:
+        return self.inner.cursor(model)
+
+    def close(self) -> None:
+        """
+        Wait for running operations and stop threads. The inner storage is not closed.
+        """
+        self._executor.shutdown()
+        if self._writer is not self._executor:
+            self._writer.shutdown()
+
+    async def __aenter__(self) -> 'AsyncStorage':
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def __str__(self) -> str:
+        return f'AsyncStorage(inner={self.inner}, max_workers={self.max_workers})'
@@ -1,15 +1,170 @@
 import abc
-from typing import TypeVar, Union, Tuple, Type, Optional, Any, Iterable
+import base64
+import functools
+import itertools
+from typing import TypeVar, Union, Tuple, Type, Optional, Any, Iterable, List, Iterator, Hashable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .query import Query
 
 StoredModel = TypeVar('StoredModel')
 RelatedModel = TypeVar('RelatedModel')
 Related = Union[RelatedModel, Tuple[RelatedModel, Any]]
+RawModel = Tuple[Any, Union[str, bytes]]
+
+
+def encode_cursor(model_id: Any) -> str:
+    """
+    Encode model ID to an opaque cursor.
+    :param model_id: Model ID.
+    :return: Cursor.
+    """
+    return base64.urlsafe_b64encode(str(model_id).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[str]:
+    """
+    Decode model ID (as string) from the cursor made by `encode_cursor()`.
+    :param cursor: Cursor.
+    :return: Model ID or None if cursor is empty.
+    """
+    if not cursor:
+        return None
+    return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+
+
+def model_indexes(model_class: Type[StoredModel]) -> Tuple[Tuple[str, ...], ...]:
+    """
+    Get indexes declared for the model class with `@saveable(indexes=...)`.
+    :param model_class: Model class.
+    :return: Tuple of indexes, each index is a tuple of field names.
+    """
+    return getattr(model_class, '__pys_indexes__', ())
+
+
+@functools.lru_cache(maxsize=None)
+def _pydantic_adapter(value_type: type) -> Any:
+    from pydantic import TypeAdapter
+    return TypeAdapter(value_type)
+
+
+def field_value(value: Any, model_class: Optional[Type[StoredModel]] = None) -> Any:
+    """
+    Convert field value to the form it has in JSON of models, so values are comparable with stored content.
+    :param value: Field value.
+    :param model_class: Model class, values of Pydantic models (and Pydantic values) are converted by Pydantic.
+    :return: JSON compatible value.
+    """
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if hasattr(model_class, '__pydantic_serializer__') or hasattr(value, '__pydantic_serializer__'):
+        return _pydantic_adapter(type(value)).dump_python(value, mode='json')
+    import msgspec
+    return msgspec.to_builtins(value)
+
+
+def json_fields(content: Union[str, bytes, memoryview]) -> dict:
+    """
+    Decode field values of a model from its JSON.
+    :param content: Raw content of the model.
+    :return: Field values as they are in JSON, empty if the content is not a JSON object.
+    """
+    import msgspec
+    try:
+        fields = msgspec.json.decode(content)
+    except msgspec.DecodeError:
+        return {}
+    return fields if isinstance(fields, dict) else {}
+
+
+def class_key(model_class: Type[StoredModel], *related_model: Related) -> str:
+    """
+    Get the key of models of the class related to the given models. It is the path of their directory
+    in file storage without shards, e.g. `Author/leo/Book`.
+    :param model_class: Model class.
+    :param related_model: Related model(s) -- model that the models are belong to.
+    :return: Key.
+    """
+    parts = []
+    for model in related_model:
+        if isinstance(model, tuple):
+            parts += [model[0].__name__, str(model[1])]
+        else:
+            parts += [model.__class__.__name__, str(model.__my_id__())]
+    parts.append(model_class.__name__)
+    return '/'.join(parts)
+
+
+def accepts_bytes(model_class: Type[StoredModel]) -> bool:
+    """
+    Check if the model class supports bytes: it has `__json_bytes__()` and its factories accept bytes.
+    :param model_class: Model class.
+    :return: True if raw content can be passed as bytes.
+    """
+    return hasattr(model_class, '__json_bytes__')
+
+
+def model_json(model: StoredModel) -> bytes:
+    """
+    Get JSON representation of the model as UTF-8 bytes, without transcoding if the model has `__json_bytes__()`.
+    :param model: Model.
+    :return: JSON bytes.
+    """
+    json_bytes = getattr(model, '__json_bytes__', None)
+    if json_bytes is not None:
+        return json_bytes()
+    return model.__json__().encode('utf-8')
+
+
+def raw_content(model_class: Type[StoredModel],
+                content: Union[str, bytes, memoryview]) -> Union[str, bytes, memoryview]:
+    """
+    Convert raw content read by a storage to the type accepted by the model class factories.
+    :param model_class: Model class.
+    :param content: Raw content as str, UTF-8 bytes or memoryview of them.
+    :return: Memoryview for classes decoding buffers (`__pys_buffers__`), bytes for classes supporting bytes,
+        str otherwise.
+    """
+    if isinstance(content, str):
+        return content
+    if not accepts_bytes(model_class):
+        return str(content, 'utf-8')
+    if isinstance(content, memoryview) and not getattr(model_class, '__pys_buffers__', False):
+        return bytes(content)
+    return content
+
+
+def decode_model(model_class: Type[StoredModel], content: Union[str, bytes], model_id: Any) -> StoredModel:
+    """
+    Create model from raw content with `__factory__()`.
+    :param model_class: Model class.
+    :param content: Raw content as str or UTF-8 bytes.
+    :param model_id: Model ID.
+    :return: Model.
+    """
+    return model_class.__factory__(raw_content(model_class, content), model_id)
+
+
+def decode_many(model_class: Type[StoredModel], raw_models: List[RawModel]) -> List[StoredModel]:
+    """
+    Create models from raw content at once with `__factory_many__()` if the model class has it.
+    :param model_class: Model class.
+    :param raw_models: List of (model ID, raw content) pairs.
+    :return: List of models in the same order.
+    """
+    factory_many = getattr(model_class, '__factory_many__', None)
+    if factory_many is None:
+        return [decode_model(model_class, content, model_id) for model_id, content in raw_models]
+    return factory_many([raw_content(model_class, content) for _, content in raw_models],
+                        [model_id for model_id, _ in raw_models])
 
 
 class BaseStorage(abc.ABC):
     """
     Abstract base storage
     """
+    decode_batch_size = 256
+
     def load(self, model_class: Type[StoredModel], model_id: Any,
              *related_model: Related) \
             -> Optional[StoredModel]:
@@ -46,15 +201,170 @@ class BaseStorage(abc.ABC):
         raise NotImplementedError
 
     def list(self, model_class: Type[StoredModel],
-             *related_model: Related) -> Iterable[StoredModel]:
+             *related_model: Related,
+             limit: Optional[int] = None,
+             after: Optional[str] = None) -> Iterator[StoredModel]:
         """
-        List models.
+        List models ordered by ID. Models are loaded lazily while iterating.
         :param model_class: Model class
         :param related_model: Related model(s) -- model that the listed models are belong to.
-        :return: List of found models.
+        :param limit: Maximum number of models to list.
+        :param after: Cursor made by `cursor()` to continue listing after.
+        :return: Iterator over found models.
+        """
+        yield from self._decode_batches(
+            model_class, self._iter_raw(model_class, *related_model, limit=limit, after=decode_cursor(after)))
+
+    def _decode_batches(self, model_class: Type[StoredModel], raw_models: Iterator[RawModel]) \
+            -> Iterator[StoredModel]:
+        while batch := list(itertools.islice(raw_models, self.decode_batch_size)):
+            yield from decode_many(model_class, batch)
+
+    def _iter_raw(self, model_class: Type[StoredModel],
+                  *related_model: Related,
+                  limit: Optional[int] = None,
+                  after: Optional[str] = None) -> Iterator[RawModel]:
+        """
+        Iterate over raw content of models ordered by ID.
+        :param model_class: Model class
+        :param related_model: Related model(s) -- model that the listed models are belong to.
+        :param limit: Maximum number of models to list.
+        :param after: Model ID (as string) to continue listing after.
+        :return: Iterator over (model ID, raw content) pairs.
         """
         raise NotImplementedError
 
+    def list_ids(self, model_class: Type[StoredModel],
+                 *related_model: Related,
+                 limit: Optional[int] = None,
+                 after: Optional[str] = None) -> Iterator[Any]:
+        """
+        List model IDs ordered by ID without loading models.
+        :param model_class: Model class
+        :param related_model: Related model(s) -- model that the listed models are belong to.
+        :param limit: Maximum number of IDs to list.
+        :param after: Cursor made by `cursor()` to continue listing after.
+        :return: Iterator over IDs.
+        """
+        for model_id, _ in self._iter_raw(model_class, *related_model, limit=limit, after=decode_cursor(after)):
+            yield model_id
+
+    def count(self, model_class: Type[StoredModel], *related_model: Related) -> int:
+        """
+        Count models without loading them.
+        :param model_class: Model class
+        :param related_model: Related model(s) -- model that the counted models are belong to.
+        :return: Number of models.
+        """
+        return sum(1 for _ in self.list_ids(model_class, *related_model))
+
+    def exists(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> bool:
+        """
+        Check if model exists without loading it.
+        :param model_class: Model class
+        :param model_id: Model ID.
+        :param related_model: Related model(s) -- model that the checked model is belong to.
+        :return: True if model exists.
+        """
+        return self.load(model_class, model_id, *related_model) is not None
+
+    def stamp(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> Optional[Hashable]:
+        """
+        Get a stamp of the stored model that is changed by every write of it, also by other processes.
+        Caches keep the stamp with a cached model and compare it to the current one to revalidate the model.
+        :param model_class: Model class
+        :param model_id: Model ID.
+        :param related_model: Related model(s) -- model that the model is belong to.
+        :return: Stamp or None if the model is not found or the storage can not provide a reliable stamp.
+        """
+        return None
+
+    def list_stamp(self, model_class: Type[StoredModel], *related_model: Related) -> Optional[Hashable]:
+        """
+        Get a stamp of the models list that is changed by every write of the listed models, also by other processes.
+        :param model_class: Model class
+        :param related_model: Related model(s) -- model that the listed models are belong to.
+        :return: Stamp or None if there are no models or the storage can not provide a reliable stamp.
+        """
+        return None
+
+    @staticmethod
+    def cursor(model: StoredModel) -> str:
+        """
+        Get opaque cursor to continue listing after the given model.
+        :param model: The last listed model.
+        :return: Cursor to be passed as `after` to `list()`.
+        """
+        return encode_cursor(model.__my_id__())
+
+    def find_by(self, model_class: Type[StoredModel],
+                *related_model: Related,
+                **fields: Any) -> Iterator[StoredModel]:
+        """
+        Find models by field values. Storages use indexes declared with `@saveable(indexes=...)`
+        where they support them, otherwise all models are scanned.
+        :param model_class: Model class.
+        :param related_model: Related model(s) -- model that the found models are belong to.
+        :param fields: Field names with expected values.
+        :return: Iterator over found models.
+        """
+        return iter(self.query(model_class, *related_model).where(**fields))
+
+    def query(self, model_class: Type[StoredModel], *related_model: Related) -> 'Query':
+        """
+        Start a query over models: `storage.query(Book).where('year', '>', 1860).order_by('-year').limit(10)`.
+        :param model_class: Model class.
+        :param related_model: Related model(s) -- model that the queried models are belong to.
+        :return: Query, iterate it to get found models.
+        """
+        from .query import Query
+        return Query(self, model_class, *related_model)
+
+    def _execute_query(self, query: 'Query') -> Iterator[StoredModel]:
+        """
+        Run the query. By default, the query is evaluated over raw JSON of all listed models,
+        only found models are created.
+        :param query: Query.
+        :return: Iterator over found models.
+        """
+        return self._decode_batches(
+            query.model_class, query.evaluate(self._iter_raw(query.model_class, *query.related_model)))
+
+    def save_many(self, models: Iterable[StoredModel],
+                  *related_model: Related) -> List[Any]:
+        """
+        Save several models at once. All models share the same relation.
+
+        :param models: Models to save.
+        :param related_model: Related model(s) -- model that the stored models are belong to.
+        :return: List of saved model IDs in the order of `models`.
+        """
+        return [self.save(model, *related_model) for model in models]
+
+    def load_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                  *related_model: Related) -> List[Optional[StoredModel]]:
+        """
+        Load several models of the same class at once.
+
+        :param model_class: Class of the models.
+        :param model_ids: Model IDs.
+        :param related_model: Related model(s) -- model that the loaded models are belong to.
+        :return: List of loaded models in the order of `model_ids`, None for models that are not found.
+        """
+        return [self.load(model_class, model_id, *related_model) for model_id in model_ids]
+
+    def delete_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                    *related_model: Related) -> None:
+        """
+        Delete several models of the same class at once.
+
+        :param model_class: Model class.
+        :param model_ids: Model IDs.
+        :param related_model: Related model(s) -- model that the deleted models are belong to.
+        """
+        for model_id in model_ids:
+            self.delete(model_class, model_id, *related_model)
+
     def destroy(self) -> None:
         """
         Destroy storage
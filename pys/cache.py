@@ -0,0 +1,326 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Type, Any, Optional, Iterable, List, Iterator, Tuple, Dict, Set, NamedTuple, Hashable, Callable, \
+    TYPE_CHECKING
+
+from .base import BaseStorage, StoredModel, Related, RawModel, model_json
+
+if TYPE_CHECKING:
+    from .query import Query
+
+RelationPath = Tuple[Tuple[Type, str], ...]
+
+
+class CacheStats(NamedTuple):
+    """
+    Cache statistics
+    """
+    hits: int
+    misses: int
+    evictions: int
+    items: int
+    size: int
+
+    @property
+    def hit_ratio(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+
+class CachedStorage(BaseStorage):
+    """
+    Read-through LRU cache of loaded models over any storage. Cached models are shared between callers,
+    so a changed model shall be saved to keep the cache consistent. The cache is kept in memory of the process,
+    changes made by other processes are seen only with `validate=True` if the inner storage provides stamps.
+    """
+    def __init__(self, inner: BaseStorage,
+                 max_items: Optional[int] = 1024,
+                 max_bytes: Optional[int] = None,
+                 cache_lists: bool = False,
+                 validate: bool = False) -> None:
+        """
+        Cache models loaded from the inner storage.
+        :param inner: Storage to cache.
+        :param max_items: Maximum number of cached models (and lists), None for no limit.
+        :param max_bytes: Maximum total size of JSON content of cached models, None for no limit.
+        :param cache_lists: Cache results of `list()` per model class and related models.
+        :param validate: Revalidate cached models with stamps of the inner storage on every hit
+            to see changes made by other processes. Models without stamps are not cached then.
+        """
+        self.inner = inner
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.cache_lists = cache_lists
+        self.validate = validate
+        # Cached value, its size and stamp
+        self._entries: OrderedDict[Hashable, Tuple[Any, int, Optional[Hashable]]] = OrderedDict()
+        # Cache keys by relation path of the cached models, to invalidate children of deleted models
+        self._children: Dict[RelationPath, Set[Hashable]] = {}
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        # Incremented by every invalidation, a model loaded during invalidation is not cached
+        self._generation = 0
+        # Number of open transactions, models loaded inside of them are not cached
+        self._transactions = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _relation_path(related_model: Tuple[Related, ...]) -> RelationPath:
+        return tuple((model[0], str(model[1])) if isinstance(model, tuple)
+                     else (model.__class__, str(model.__my_id__())) for model in related_model)
+
+    @staticmethod
+    def _model_key(model_class: Type[StoredModel], model_id: Any, path: RelationPath) -> Hashable:
+        return path, model_class, str(model_id)
+
+    @staticmethod
+    def _list_key(model_class: Type[StoredModel], path: RelationPath,
+                  limit: Optional[int], after: Optional[str]) -> Hashable:
+        return path, model_class, '__list__', limit, after
+
+    def _model_size(self, model: StoredModel) -> int:
+        return len(model_json(model)) if self.max_bytes is not None else 0
+
+    def _model_stamp(self, model_class: Type[StoredModel], model_id: Any,
+                     related_model: Tuple[Related, ...]) -> Optional[Callable[[], Optional[Hashable]]]:
+        if not self.validate:
+            return None
+        return lambda: self.inner.stamp(model_class, model_id, *related_model)
+
+    def _get(self, key: Hashable, stamp: Optional[Callable[[], Optional[Hashable]]]) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and stamp is not None and stamp() != entry[2]:
+            # Changed by another process, the entry is replaced when loaded again
+            entry = None
+        with self._lock:
+            if entry is None or key not in self._entries:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def _put(self, key: Hashable, value: Any, size: int, generation: int, stamp: Optional[Hashable]) -> None:
+        if self.validate and stamp is None:
+            return
+        with self._lock:
+            if generation != self._generation or self._transactions:
+                # The value may be stale: the storage was changed while it was being loaded,
+                # or it is read inside of a transaction which may be rolled back
+                return
+            self._discard(key)
+            self._entries[key] = (value, size, stamp)
+            self._children.setdefault(key[0], set()).add(key)
+            self._size += size
+            while self._entries and (
+                    (self.max_items is not None and len(self._entries) > self.max_items)
+                    or (self.max_bytes is not None and self._size > self.max_bytes)):
+                self._discard(next(iter(self._entries)))
+                self._evictions += 1
+
+    def _discard(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= entry[1]
+        keys = self._children[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._children[key[0]]
+
+    def _invalidate(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                    path: RelationPath, deleted: bool = False) -> None:
+        with self._lock:
+            self._generation += 1
+            for model_id in model_ids:
+                self._discard(self._model_key(model_class, model_id, path))
+                if deleted:
+                    # Models related to the deleted one are deleted with it
+                    prefix = path + ((model_class, str(model_id)),)
+                    for children_path in [p for p in self._children if p[:len(prefix)] == prefix]:
+                        for key in list(self._children.get(children_path, ())):
+                            self._discard(key)
+            for key in [key for key in self._children.get(path, ()) if key[2] == '__list__' and key[1] is model_class]:
+                self._discard(key)
+
+    def _invalidate_saved(self, models: Iterable[StoredModel], related_model: Tuple[Related, ...]) -> None:
+        by_class: Dict[Type[StoredModel], List[Any]] = {}
+        for model in models:
+            by_class.setdefault(model.__class__, []).append(model.__my_id__())
+        path = self._relation_path(related_model)
+        for model_class, model_ids in by_class.items():
+            self._invalidate(model_class, model_ids, path)
+        # Storages may save related models as well
+        for i, model in enumerate(related_model):
+            if not isinstance(model, tuple):
+                self._invalidate(model.__class__, [model.__my_id__()], path[:i])
+
+    def clear(self) -> None:
+        """
+        Drop all cached models and lists.
+        """
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._children.clear()
+            self._size = 0
+
+    @property
+    def stats(self) -> CacheStats:
+        """
+        Get cache statistics.
+        :return: Hits, misses, evictions, number of cached items and their size.
+        """
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions, len(self._entries), self._size)
+
+    def load(self, model_class: Type[StoredModel], model_id: Any,
+             *related_model: Related) -> Optional[StoredModel]:
+        key = self._model_key(model_class, model_id, self._relation_path(related_model))
+        stamp = self._model_stamp(model_class, model_id, related_model)
+        model = self._get(key, stamp)
+        if model is not None:
+            return model
+        generation = self._generation
+        # The stamp is taken before loading, so a write made while loading changes it
+        loaded_stamp = stamp() if stamp else None
+        model = self.inner.load(model_class, model_id, *related_model)
+        if model is not None:
+            self._put(key, model, self._model_size(model), generation, loaded_stamp)
+        return model
+
+    def load_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                  *related_model: Related) -> List[Optional[StoredModel]]:
+        path = self._relation_path(related_model)
+        model_ids = list(model_ids)
+        stamps = [self._model_stamp(model_class, model_id, related_model) for model_id in model_ids]
+        models = [self._get(self._model_key(model_class, model_id, path), stamp)
+                  for model_id, stamp in zip(model_ids, stamps)]
+        missed = [i for i, model in enumerate(models) if model is None]
+        if missed:
+            generation = self._generation
+            loaded_stamps = [stamps[i]() if stamps[i] else None for i in missed]
+            loaded = self.inner.load_many(model_class, [model_ids[i] for i in missed], *related_model)
+            for i, model, loaded_stamp in zip(missed, loaded, loaded_stamps):
+                models[i] = model
+                if model is not None:
+                    self._put(self._model_key(model_class, model_ids[i], path), model,
+                              self._model_size(model), generation, loaded_stamp)
+        return models
+
+    def save(self, model: StoredModel, *related_model: Related) -> Any:
+        try:
+            return self.inner.save(model, *related_model)
+        finally:
+            self._invalidate_saved([model], related_model)
+
+    def save_many(self, models: Iterable[StoredModel], *related_model: Related) -> List[Any]:
+        models = list(models)
+        try:
+            return self.inner.save_many(models, *related_model)
+        finally:
+            self._invalidate_saved(models, related_model)
+
+    def delete(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> None:
+        try:
+            self.inner.delete(model_class, model_id, *related_model)
+        finally:
+            self._invalidate(model_class, [model_id], self._relation_path(related_model), deleted=True)
+
+    def delete_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                    *related_model: Related) -> None:
+        model_ids = list(model_ids)
+        try:
+            self.inner.delete_many(model_class, model_ids, *related_model)
+        finally:
+            self._invalidate(model_class, model_ids, self._relation_path(related_model), deleted=True)
+
+    def list(self, model_class: Type[StoredModel],
+             *related_model: Related,
+             limit: Optional[int] = None,
+             after: Optional[str] = None) -> Iterator[StoredModel]:
+        if not self.cache_lists:
+            yield from self.inner.list(model_class, *related_model, limit=limit, after=after)
+            return
+
+        key = self._list_key(model_class, self._relation_path(related_model), limit, after)
+        stamp = (lambda: self.inner.list_stamp(model_class, *related_model)) if self.validate else None
+        models = self._get(key, stamp)
+        if models is None:
+            generation = self._generation
+            listed_stamp = stamp() if stamp else None
+            models = tuple(self.inner.list(model_class, *related_model, limit=limit, after=after))
+            self._put(key, models, sum(self._model_size(model) for model in models), generation, listed_stamp)
+        yield from models
+
+    def _iter_raw(self, model_class: Type[StoredModel],
+                  *related_model: Related,
+                  limit: Optional[int] = None,
+                  after: Optional[str] = None) -> Iterator[RawModel]:
+        return self.inner._iter_raw(model_class, *related_model, limit=limit, after=after)
+
+    def list_ids(self, model_class: Type[StoredModel],
+                 *related_model: Related,
+                 limit: Optional[int] = None,
+                 after: Optional[str] = None) -> Iterator[Any]:
+        return self.inner.list_ids(model_class, *related_model, limit=limit, after=after)
+
+    def count(self, model_class: Type[StoredModel], *related_model: Related) -> int:
+        return self.inner.count(model_class, *related_model)
+
+    def exists(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> bool:
+        if not self.validate:
+            with self._lock:
+                if self._model_key(model_class, model_id, self._relation_path(related_model)) in self._entries:
+                    return True
+        return self.inner.exists(model_class, model_id, *related_model)
+
+    def stamp(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> Optional[Hashable]:
+        return self.inner.stamp(model_class, model_id, *related_model)
+
+    def list_stamp(self, model_class: Type[StoredModel], *related_model: Related) -> Optional[Hashable]:
+        return self.inner.list_stamp(model_class, *related_model)
+
+    def find_by(self, model_class: Type[StoredModel],
+                *related_model: Related,
+                **fields: Any) -> Iterator[StoredModel]:
+        return self.inner.find_by(model_class, *related_model, **fields)
+
+    def query(self, model_class: Type[StoredModel], *related_model: Related) -> 'Query':
+        return self.inner.query(model_class, *related_model)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run writes in `transaction()` of the inner storage. Models loaded inside of the transaction are not cached
+        and the cache is cleared if the transaction is rolled back.
+        """
+        with self._lock:
+            self._transactions += 1
+        try:
+            with self.inner.transaction():
+                yield self
+        except BaseException:
+            self.clear()
+            raise
+        finally:
+            with self._lock:
+                self._transactions -= 1
+                self._generation += 1
+
+    def destroy(self) -> None:
+        self.clear()
+        self.inner.destroy()
+
+    def __getattr__(self, name: str) -> Any:
+        # Storage specific methods like `commit()` or `close()` go to the inner storage
+        if name == 'inner':
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    def __str__(self) -> str:
+        return f'CachedStorage(inner={self.inner}, max_items={self.max_items}, max_bytes={self.max_bytes})'
@@ -0,0 +1,180 @@
+import bisect
+import dbm
+import importlib
+import threading
+from pathlib import Path
+from typing import Type, Any, Optional, Iterable, Union, List, Iterator, Dict, Set
+
+from .base import BaseStorage, StoredModel, Related, RawModel, class_key, decode_cursor, decode_model, decode_many, \
+    model_json
+
+# Backends in the order of preference, `dumb` is always available
+BACKENDS = ('gnu', 'ndbm', 'dumb')
+
+
+def _backend(path: Path) -> str:
+    existing = dbm.whichdb(str(path))
+    if existing:
+        return existing.rpartition('.')[2]
+    for backend in BACKENDS:
+        try:
+            importlib.import_module(f'dbm.{backend}')
+            return backend
+        except ImportError:
+            pass
+
+
+class Storage(BaseStorage):
+    """
+    Key/value storage on the standard `dbm` module: `dbm.gnu`, `dbm.ndbm` or `dbm.dumb`, whichever is available.
+    Models are JSON values by keys like paths of model files in file storage, e.g. `Author/leo/Book/1`.
+    Models keys are registered in memory by class and related models when the storage is opened, so lists
+    do not scan the database. Thread safe, the database is used by one process.
+    """
+    base_path: Path
+
+    def __init__(self, base_path: Union[str, Path], backend: Optional[str] = None) -> None:
+        """
+        Database file
+        :param base_path: base path, some backends add suffixes to it.
+        :param backend: `gnu`, `ndbm` or `dumb`, None for the backend of the existing database
+            or the first available one.
+        """
+        self.base_path = base_path if isinstance(base_path, Path) else Path(base_path)
+        self._lock = threading.RLock()
+        self.backend = backend or _backend(self.base_path)
+        self._db = importlib.import_module(f'dbm.{self.backend}').open(str(self.base_path), 'c')
+        # Model IDs by class key, and class keys of models related to a model by its key
+        self._ids: Dict[str, Set[str]] = {}
+        self._children: Dict[str, Set[str]] = {}
+        for key in self._db.keys():
+            self._register(*key.decode('utf-8').rsplit('/', 1))
+
+    def _register(self, key: str, model_id: str) -> None:
+        ids = self._ids.get(key)
+        if ids is None:
+            ids = self._ids[key] = set()
+            parent, _, _ = key.rpartition('/')
+            if parent:
+                self._children.setdefault(parent, set()).add(key)
+        ids.add(model_id)
+
+    def _unregister(self, key: str, model_id: str) -> None:
+        ids = self._ids.get(key)
+        if ids is None:
+            return
+        ids.discard(model_id)
+        if not ids:
+            del self._ids[key]
+            parent, _, _ = key.rpartition('/')
+            children = self._children.get(parent)
+            if children is not None:
+                children.discard(key)
+                if not children:
+                    del self._children[parent]
+
+    def _get(self, key: str, model_id: str) -> Optional[bytes]:
+        with self._lock:
+            return self._db.get(f'{key}/{model_id}'.encode('utf-8'))
+
+    def _put(self, key: str, model_id: str, value: bytes) -> None:
+        self._db[f'{key}/{model_id}'.encode('utf-8')] = value
+        self._register(key, model_id)
+
+    def _delete(self, key: str, model_id: str) -> None:
+        # Models related to the deleted one are deleted with it
+        for child in list(self._children.get(f'{key}/{model_id}', ())):
+            for child_id in list(self._ids.get(child, ())):
+                self._delete(child, child_id)
+        if model_id in self._ids.get(key, ()):
+            del self._db[f'{key}/{model_id}'.encode('utf-8')]
+            self._unregister(key, model_id)
+
+    def load(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> Optional[StoredModel]:
+        raw_content = self._get(class_key(model_class, *related_model), str(model_id))
+        return decode_model(model_class, raw_content, model_id) if raw_content is not None else None
+
+    def save(self, model: StoredModel, *related_model: Related) -> Any:
+        model_id = model.__my_id__()
+        with self._lock:
+            self._put(class_key(model.__class__, *related_model), str(model_id), model_json(model))
+        return model_id
+
+    def delete(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> None:
+        with self._lock:
+            self._delete(class_key(model_class, *related_model), str(model_id))
+
+    def save_many(self, models: Iterable[StoredModel], *related_model: Related) -> List[Any]:
+        ids = []
+        with self._lock:
+            for model in models:
+                model_id = model.__my_id__()
+                self._put(class_key(model.__class__, *related_model), str(model_id), model_json(model))
+                ids.append(model_id)
+        return ids
+
+    def load_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                  *related_model: Related) -> List[Optional[StoredModel]]:
+        key = class_key(model_class, *related_model)
+        model_ids = list(model_ids)
+        with self._lock:
+            raw_contents = [self._get(key, str(model_id)) for model_id in model_ids]
+        found = [(model_id, raw_content) for model_id, raw_content in zip(model_ids, raw_contents)
+                 if raw_content is not None]
+        models = iter(decode_many(model_class, found))
+        return [next(models) if raw_content is not None else None for raw_content in raw_contents]
+
+    def delete_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                    *related_model: Related) -> None:
+        key = class_key(model_class, *related_model)
+        with self._lock:
+            for model_id in model_ids:
+                self._delete(key, str(model_id))
+
+    def _page(self, model_class: Type[StoredModel], *related_model: Related,
+              limit: Optional[int] = None, after: Optional[str] = None) -> List[str]:
+        with self._lock:
+            ids = sorted(self._ids.get(class_key(model_class, *related_model), ()))
+        if after is not None:
+            ids = ids[bisect.bisect_right(ids, after):]
+        return ids if limit is None else ids[:limit]
+
+    def _iter_raw(self, model_class: Type[StoredModel],
+                  *related_model: Related,
+                  limit: Optional[int] = None,
+                  after: Optional[str] = None) -> Iterator[RawModel]:
+        key = class_key(model_class, *related_model)
+        for model_id in self._page(model_class, *related_model, limit=limit, after=after):
+            raw_content = self._get(key, model_id)
+            if raw_content is not None:
+                yield model_id, raw_content
+
+    def list_ids(self, model_class: Type[StoredModel],
+                 *related_model: Related,
+                 limit: Optional[int] = None,
+                 after: Optional[str] = None) -> Iterator[Any]:
+        return iter(self._page(model_class, *related_model, limit=limit, after=decode_cursor(after)))
+
+    def count(self, model_class: Type[StoredModel], *related_model: Related) -> int:
+        with self._lock:
+            return len(self._ids.get(class_key(model_class, *related_model), ()))
+
+    def exists(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> bool:
+        with self._lock:
+            return str(model_id) in self._ids.get(class_key(model_class, *related_model), ())
+
+    def __str__(self) -> str:
+        return f'dbm.Storage(base_path={self.base_path}, backend={self.backend})'
+
+    def close(self) -> None:
+        """
+        Write pending changes and close the database.
+        """
+        with self._lock:
+            self._db.close()
+
+    def destroy(self) -> None:
+        self.close()
+        # Backends add their own suffixes to the database file
+        for suffix in ('', '.db', '.pag', '.dir', '.dat', '.bak'):
+            self.base_path.with_name(self.base_path.name + suffix).unlink(missing_ok=True)
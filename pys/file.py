@@ -1,11 +1,30 @@
+import bisect
+import hashlib
+import mmap
 import os
 import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Type, Optional, Tuple, Iterable, Any, Union
+from typing import Type, Optional, Tuple, Iterable, Any, Union, List, Dict, Iterator, Set, NamedTuple
 
+import msgspec
 from filelock import FileLock
 
-from .base import BaseStorage, StoredModel, RelatedModel, Related
+from .base import BaseStorage, StoredModel, RelatedModel, Related, RawModel, model_indexes, field_value, \
+    json_fields, decode_cursor, decode_many, decode_model, model_json
+
+
+class Stamp(NamedTuple):
+    """
+    State of a file or directory that is changed by writes: inode, modification time and size
+    """
+    inode: int
+    mtime_ns: int
+    size: int
 
 
 class Storage(BaseStorage):
@@ -13,73 +32,500 @@ class Storage(BaseStorage):
     File based storage implementation. Thread and interprocess safe.
     """
     base_path: Path
+    # Number of directories with cached scan results
+    scan_cache_size = 1024
 
-    def __init__(self, base_path: Union[str, Path]) -> None:
+    def __init__(self, base_path: Union[str, Path], shard_levels: int = 0, shard_width: int = 2,
+                 atomic_writes: bool = False, fsync: bool = False, read_workers: int = 0,
+                 mmap_threshold: Optional[int] = None, mtime_resolution: float = 2.0) -> None:
         """
         Base path for the storage files
         :param base_path: base path.
+        :param shard_levels: Number of directory levels named by hash prefix of model ID,
+            e.g. `Book/ab/cd/<id>.json` for 2 levels. Use `reshard()` to change it for existing storage.
+        :param shard_width: Number of hex digits of hash in a shard directory name.
+        :param atomic_writes: Write model files to a temporary file and rename it over the model file,
+            so readers never see partial content and read without locks. Locks are kept for index updates.
+        :param fsync: Flush written files and their directories to disk before the write returns.
+        :param read_workers: Number of threads reading model files for `list()` and `load_many()`, 0 to read them
+            in the calling thread.
+        :param mmap_threshold: Size of model files in bytes from which `load()` decodes them from memory map
+            instead of reading to memory, None to always read files. Models with `msgspec.Raw` fields
+            shall not be loaded from memory map.
+        :param mtime_resolution: Modification time resolution of the file system in seconds: files changed
+            more recently have no stamps, as another change within it may keep the same stamp. The default suits
+            file systems with 1-2 seconds resolution (FAT, some network file systems), local file systems
+            with nanosecond timestamps allow much less, e.g. 0.02.
         """
         self.base_path = base_path if isinstance(base_path, Path) else Path(base_path)
+        self.shard_levels = shard_levels
+        self.shard_width = shard_width
+        self.atomic_writes = atomic_writes
+        self.fsync = fsync
+        self.read_workers = read_workers
+        self.mmap_threshold = mmap_threshold
+        self.mtime_resolution = mtime_resolution
+        self._scans: OrderedDict[Path, Tuple[Stamp, Dict[str, str]]] = OrderedDict()
+        self._scans_lock = threading.Lock()
+        self._pool: Optional[ThreadPoolExecutor] = None
 
-    @staticmethod
-    def _get_model_path(model_class: Type[StoredModel], model_id: Any,
-                        *related_model: Union[RelatedModel, Tuple[Type[RelatedModel], Any]]) -> Path:
+    def _class_path(self, model_class: Type[StoredModel],
+                    *related_model: Union[RelatedModel, Tuple[Type[RelatedModel], Any]]) -> Path:
         path = Path()
-        if not related_model:
-            path /= ''
-        else:
-            for model in related_model:
-                if isinstance(model, tuple):
-                    path /= Storage._get_model_path(*model)
-                else:
-                    path /= Storage._get_model_path(model.__class__, model.__my_id__())
+        for model in related_model:
+            if isinstance(model, tuple):
+                path /= self._get_model_path(*model)
+            else:
+                path /= self._get_model_path(model.__class__, model.__my_id__())
+        return path / model_class.__name__
+
+    def _shards(self, stem: str) -> List[str]:
+        # Shards depend on the model file name, so a file found by scan has the same shards as its model
+        if not self.shard_levels:
+            return []
+        digest = hashlib.sha1(stem.encode('utf-8')).hexdigest()
+        return [digest[i * self.shard_width:(i + 1) * self.shard_width] for i in range(self.shard_levels)]
+
+    def _get_model_path(self, model_class: Type[StoredModel], model_id: Any,
+                        *related_model: Union[RelatedModel, Tuple[Type[RelatedModel], Any]]) -> Path:
+        model_id = str(model_id)
+        return self._class_path(model_class, *related_model).joinpath(*self._shards(Path(model_id).stem), model_id)
+
+    def _model_file(self, class_dir: Path, model_id: Any) -> Path:
+        return self._stem_file(class_dir, Path(str(model_id)).stem)
 
-        return path / model_class.__name__ / str(model_id)
+    def _stem_file(self, class_dir: Path, stem: str) -> Path:
+        return class_dir.joinpath(*self._shards(stem), f'{stem}.json')
 
     def _prepare_file(self, model_class: Type[StoredModel], model_id: Any,
                       *related_model: Related):
-        path = self.base_path / Storage._get_model_path(model_class, model_id, *related_model).with_suffix('.json')
+        path = self.base_path / self._get_model_path(model_class, model_id, *related_model).with_suffix('.json')
         lock = path.with_suffix('.lock')
         path.parent.mkdir(parents=True, exist_ok=True)
         return path, FileLock(lock)
 
+    def _list_lock(self, model_class: Type[StoredModel], *related_model: Related) -> Tuple[Path, FileLock]:
+        class_dir = self._parent_path(model_class, *related_model)
+        class_dir.mkdir(parents=True, exist_ok=True)
+        return class_dir, FileLock(class_dir / '__list__.lock')
+
+    def _touch(self, class_dir: Path) -> None:
+        # Files are not in the class directory with shards, touch it to change the list stamp
+        if self.shard_levels:
+            os.utime(class_dir)
+
+    @staticmethod
+    def _write_atomic(path: Path, content: bytes, fsync: bool = False) -> None:
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(content)
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        if fsync and os.name == 'posix':
+            # Rename is durable when the directory is flushed
+            fd = os.open(path.parent, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _write_lock(self, model_class: Type[StoredModel], lock: FileLock):
+        """
+        Get the lock for writing models. Atomic writes need no lock unless index markers are updated,
+        which reads the stored model before writing.
+        """
+        return lock if not self.atomic_writes or model_indexes(model_class) else nullcontext()
+
+    @staticmethod
+    def _index_lock(model_class: Type[StoredModel], path: Path):
+        """
+        Get the lock of a model file for batch writes, which hold the list lock only: index markers are updated
+        under the lock of the model file, as `save()` and `delete()` of the same model may run at the same time.
+        """
+        return FileLock(path.with_suffix('.lock')) if model_indexes(model_class) else nullcontext()
+
+    def _read_file(self, path: Union[str, Path]) -> Optional[bytes]:
+        """
+        Read model file or get None if it does not exist. Files replaced atomically are read without a lock.
+        """
+        if self.atomic_writes:
+            try:
+                with open(path, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+        path = Path(path)
+        if not path.exists():
+            return None
+        with FileLock(path.with_suffix('.lock')):
+            if not path.exists():
+                return None
+            return path.read_bytes()
+
+    def _load_file(self, model_class: Type[StoredModel], path: Path, model_id: Any) -> Optional[StoredModel]:
+        """
+        Read and decode model file or get None if it does not exist. Large files are decoded from memory map.
+        """
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            if self.mmap_threshold is not None and 0 < self.mmap_threshold <= os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                    return decode_model(model_class, view, model_id)
+            return decode_model(model_class, f.read(), model_id)
+
+    def _read_files(self, paths: List[Union[str, Path]]) -> List[Optional[bytes]]:
+        # File reads release the GIL, so threads read in parallel
+        if self.read_workers > 1 and len(paths) > 1:
+            with self._scans_lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.read_workers, thread_name_prefix='pys-read')
+            return list(self._pool.map(self._read_file, paths))
+        return [self._read_file(path) for path in paths]
+
+    _INDEX_DIR = '__index__'
+
+    @staticmethod
+    def _index_key(values: tuple) -> str:
+        return hashlib.sha1(msgspec.json.encode(values)).hexdigest()
+
+    def _index_markers(self, model_class: Type[StoredModel], path: Path, fields: Optional[dict]) -> Set[Path]:
+        if fields is None:
+            return set()
+        return {
+            path.parents[self.shard_levels] / Storage._INDEX_DIR / '__'.join(index) /
+            Storage._index_key(tuple(fields.get(name) for name in index)) / path.stem
+            for index in model_indexes(model_class)
+        }
+
+    @staticmethod
+    def _stored_fields(path: Path) -> Optional[dict]:
+        try:
+            fields = msgspec.json.decode(path.read_bytes())
+        except (FileNotFoundError, msgspec.DecodeError):
+            return None
+        return fields if isinstance(fields, dict) else None
+
+    @staticmethod
+    def _model_fields(model: StoredModel) -> dict:
+        # Values are taken from the model JSON, so they are equal to the stored ones whatever the field types are
+        return json_fields(model_json(model))
+
+    def _reindex(self, model_class: Type[StoredModel], path: Path, model: Optional[StoredModel]) -> None:
+        """
+        Update index markers of the model stored at `path` before it is replaced by `model` (or deleted if None).
+        Shall be called under the lock of the model file.
+        """
+        if not model_indexes(model_class):
+            return
+        stale = self._index_markers(model_class, path, self._stored_fields(path))
+        actual = self._index_markers(model_class, path, self._model_fields(model) if model is not None else None)
+        for marker in stale - actual:
+            marker.unlink(missing_ok=True)
+        for marker in actual:
+            if not marker.exists():
+                marker.parent.mkdir(parents=True, exist_ok=True)
+                marker.touch()
+
     def save(self, model: StoredModel,
              *related_model: Related) -> Any:
         model_id = model.__my_id__()
         path, lock = self._prepare_file(model.__class__, model_id, *related_model)
-        with lock:
-            path.write_text(model.__json__(), encoding='utf-8')
+        with self._write_lock(model.__class__, lock):
+            self._reindex(model.__class__, path, model)
+            if self.atomic_writes:
+                self._write_atomic(path, model_json(model), self.fsync)
+                self._touch(path.parents[self.shard_levels])
+            else:
+                path.write_bytes(model_json(model))
+                # Writing in place does not change the directory, touch it to change the list stamp
+                os.utime(path.parents[self.shard_levels])
             return model_id
 
     def load(self, model_class: Type[StoredModel], model_id: Any,
              *related_model: Related) -> Optional[StoredModel]:
+        if self.atomic_writes:
+            # Replaced files stay readable (and mapped) by their old inode
+            return self._load_file(
+                model_class,
+                self.base_path / self._get_model_path(model_class, model_id, *related_model).with_suffix('.json'),
+                model_id)
+
         path, lock = self._prepare_file(model_class, model_id, *related_model)
         with lock:
-            if not path.exists():
-                return None
-            return model_class.__factory__(path.read_text(encoding='utf-8'), model_id)
+            # The file is not written in place while it is read (or mapped) under the lock
+            return self._load_file(model_class, path, model_id)
 
     def delete(self, model_class: Type[StoredModel], model_id: str,
                *related_model: Related) -> None:
         path, lock = self._prepare_file(model_class, model_id, *related_model)
-        with lock:
+        with self._write_lock(model_class, lock):
+            self._reindex(model_class, path, None)
             path.unlink(missing_ok=True)
             sub_path = path.with_suffix('')
             if sub_path.exists():
                 shutil.rmtree(sub_path)
+            self._touch(path.parents[self.shard_levels])
+
+    def save_many(self, models: Iterable[StoredModel],
+                  *related_model: Related) -> List[Any]:
+        ids = []
+        by_class: Dict[Type[StoredModel], List[Tuple[Any, StoredModel]]] = {}
+        for model in models:
+            model_id = model.__my_id__()
+            ids.append(model_id)
+            by_class.setdefault(model.__class__, []).append((model_id, model))
+
+        for model_class, class_models in by_class.items():
+            class_dir, lock = self._list_lock(model_class, *related_model)
+            with self._write_lock(model_class, lock):
+                # Files are replaced atomically, so readers holding per-file locks never see partial content
+                for model_id, model in class_models:
+                    model_path = self._model_file(class_dir, model_id)
+                    if self.shard_levels:
+                        model_path.parent.mkdir(parents=True, exist_ok=True)
+                    with self._index_lock(model_class, model_path):
+                        self._reindex(model_class, model_path, model)
+                        self._write_atomic(model_path, model_json(model), self.fsync)
+                self._touch(class_dir)
+        return ids
+
+    def load_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                  *related_model: Related) -> List[Optional[StoredModel]]:
+        model_ids = list(model_ids)
+        parent = self._parent_path(model_class, *related_model)
+        if not parent.exists():
+            return [None] * len(model_ids)
+
+        raw_contents = self._read_files([self._model_file(parent, model_id) for model_id in model_ids])
+        found = [(model_id, raw_content) for model_id, raw_content in zip(model_ids, raw_contents)
+                 if raw_content is not None]
+        models = iter(decode_many(model_class, found))
+        return [next(models) if raw_content is not None else None for raw_content in raw_contents]
+
+    def delete_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                    *related_model: Related) -> None:
+        class_dir, lock = self._list_lock(model_class, *related_model)
+        with self._write_lock(model_class, lock):
+            for model_id in model_ids:
+                model_path = self._model_file(class_dir, model_id)
+                with self._index_lock(model_class, model_path):
+                    self._reindex(model_class, model_path, None)
+                    model_path.unlink(missing_ok=True)
+                sub_path = model_path.with_suffix('')
+                if sub_path.exists():
+                    shutil.rmtree(sub_path)
+            self._touch(class_dir)
+
+    def find_by(self, model_class: Type[StoredModel],
+                *related_model: Related,
+                **fields: Any) -> Iterator[StoredModel]:
+        indexes = [index for index in model_indexes(model_class) if set(index) <= set(fields)]
+        if not indexes:
+            yield from super().find_by(model_class, *related_model, **fields)
+            return
+
+        index = max(indexes, key=len)
+        expected = {name: field_value(value, model_class) for name, value in fields.items()}
+        parent = self._parent_path(model_class, *related_model)
+        try:
+            model_ids = sorted(os.listdir(
+                parent / self._INDEX_DIR / '__'.join(index) /
+                self._index_key(tuple(expected[name] for name in index))))
+        except FileNotFoundError:
+            return
+        for model in self.load_many(model_class, model_ids, *related_model):
+            if model is None:
+                continue
+            # Markers may be stale if the model is being changed right now
+            model_fields = self._model_fields(model)
+            if all(model_fields.get(name) == value for name, value in expected.items()):
+                yield model
 
     _JSON_EXT_END = -5
 
-    def list(self, model_class: Type[StoredModel],
-             *related_model: Related) -> Iterable[StoredModel]:
-        path, lock = self._prepare_file(model_class, '__list__', *related_model)
-        with lock:
-            for p in os.listdir(path.parent):
-                if p.endswith('.json'):
-                    yield self.load(model_class, p[:Storage._JSON_EXT_END], *related_model)
+    def _stamp(self, path: Path) -> Optional[Stamp]:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if time.time_ns() - stat.st_mtime_ns < self.mtime_resolution * 1e9:
+            # The next write within the timestamp resolution may leave the same stamp
+            return None
+        return Stamp(stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def stamp(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> Optional[Stamp]:
+        return self._stamp(self.base_path / self._get_model_path(model_class, model_id, *related_model)
+                           .with_suffix('.json'))
+
+    def list_stamp(self, model_class: Type[StoredModel], *related_model: Related) -> Optional[Stamp]:
+        # Directory is changed by creating, replacing or deleting files in it and touched by in place writes
+        return self._stamp(self._parent_path(model_class, *related_model))
+
+    def _shard_dirs(self, path: Path, levels: int, width: int) -> Iterator[Path]:
+        if not levels:
+            yield path
+            return
+        try:
+            with os.scandir(path) as entries:
+                shards = [entry.path for entry in entries
+                          if len(entry.name) == width and entry.is_dir() and
+                          all(c in '0123456789abcdef' for c in entry.name)]
+        except FileNotFoundError:
+            return
+        for shard in shards:
+            yield from self._shard_dirs(Path(shard), levels - 1, width)
+
+    def _scan(self, parent: Path) -> Dict[str, str]:
+        """
+        Get paths of model files by model IDs in the class directory and its shards. The result shall not be changed.
+        """
+        if not self.shard_levels:
+            return self._scan_dir(parent)
+        files = {}
+        for shard in self._shard_dirs(parent, self.shard_levels, self.shard_width):
+            files.update(self._scan_dir(shard))
+        return files
+
+    def _scan_ids(self, parent: Path) -> List[str]:
+        return list(self._scan_dir(parent) if not self.shard_levels else self._scan(parent))
+
+    def _scan_dir(self, parent: Path) -> Dict[str, str]:
+        """
+        Get paths of model files by model IDs in the directory. The scan is skipped if the directory
+        is not changed since the last one. The result shall not be changed.
+        """
+        stamp = self._stamp(parent)
+        with self._scans_lock:
+            scan = self._scans.get(parent)
+            if scan is not None and stamp is not None and scan[0] == stamp:
+                self._scans.move_to_end(parent)
+                return scan[1]
+        try:
+            with os.scandir(parent) as entries:
+                files = {entry.name[:Storage._JSON_EXT_END]: entry.path
+                         for entry in entries if entry.name.endswith('.json')}
+        except FileNotFoundError:
+            return {}
+        if stamp is not None:
+            with self._scans_lock:
+                self._scans[parent] = (stamp, files)
+                self._scans.move_to_end(parent)
+                if len(self._scans) > self.scan_cache_size:
+                    self._scans.popitem(last=False)
+        return files
+
+    def _parent_path(self, model_class: Type[StoredModel], *related_model: Related) -> Path:
+        return self.base_path / self._class_path(model_class, *related_model)
+
+    def list_ids(self, model_class: Type[StoredModel],
+                 *related_model: Related,
+                 limit: Optional[int] = None,
+                 after: Optional[str] = None) -> Iterator[Any]:
+        return iter(self._page(self._scan_ids(self._parent_path(model_class, *related_model)),
+                               limit, decode_cursor(after)))
+
+    def count(self, model_class: Type[StoredModel], *related_model: Related) -> int:
+        return len(self._scan_ids(self._parent_path(model_class, *related_model)))
+
+    def exists(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> bool:
+        path = self.base_path / self._get_model_path(model_class, model_id, *related_model).with_suffix('.json')
+        return path.exists()
+
+    @staticmethod
+    def _page(ids: Iterable[str], limit: Optional[int], after: Optional[str]) -> List[str]:
+        ids = sorted(ids)
+        if after is not None:
+            ids = ids[bisect.bisect_right(ids, after):]
+        return ids if limit is None else ids[:limit]
+
+    def _iter_raw(self, model_class: Type[StoredModel],
+                  *related_model: Related,
+                  limit: Optional[int] = None,
+                  after: Optional[str] = None) -> Iterator[RawModel]:
+        if self.atomic_writes:
+            files = self._scan(self._parent_path(model_class, *related_model))
+        else:
+            class_dir, lock = self._list_lock(model_class, *related_model)
+            with lock:
+                files = self._scan(class_dir)
+        # Files are read by paths found by the scan in batches decoded at once
+        model_ids = self._page(files, limit, after)
+        for start in range(0, len(model_ids), self.decode_batch_size):
+            batch = model_ids[start:start + self.decode_batch_size]
+            for model_id, raw_content in zip(batch, self._read_files([files[model_id] for model_id in batch])):
+                if raw_content is not None:
+                    yield model_id, raw_content
+
+    def reshard(self, shard_levels: int, shard_width: int = 2) -> None:
+        """
+        Move files of the storage to the layout with other shards. The storage shall not be used
+        by other threads and processes while resharding.
+        :param shard_levels: Number of directory levels named by hash prefix of model ID, 0 for no shards.
+        :param shard_width: Number of hex digits of hash in a shard directory name.
+        """
+        target = Storage(self.base_path, shard_levels, shard_width)
+        if (self.shard_levels, self.shard_width) != (shard_levels, shard_width):
+            for class_dir in self._class_dirs(self.base_path):
+                self._reshard_class(class_dir, target)
+        self.shard_levels = shard_levels
+        self.shard_width = shard_width
+        with self._scans_lock:
+            self._scans.clear()
+
+    @staticmethod
+    def _class_dirs(path: Path) -> List[Path]:
+        try:
+            with os.scandir(path) as entries:
+                return [Path(entry.path) for entry in entries if entry.is_dir() and not entry.name.startswith('.')]
+        except FileNotFoundError:
+            return []
+
+    def _reshard_class(self, class_dir: Path, target: 'Storage') -> None:
+        # Move the class directory aside, so new shards do not mix with directories of related models
+        tmp = class_dir.with_name(f'.{class_dir.name}.reshard')
+        os.replace(class_dir, tmp)
+        class_dir.mkdir()
+        if (tmp / self._INDEX_DIR).exists():
+            os.replace(tmp / self._INDEX_DIR, class_dir / self._INDEX_DIR)
+
+        for shard in list(self._shard_dirs(tmp, self.shard_levels, self.shard_width)):
+            with os.scandir(shard) as entries:
+                # Model files and directories of related models, which may be saved without the model itself
+                stems = {entry.name[:self._JSON_EXT_END] if entry.name.endswith('.json') else entry.name
+                         for entry in entries
+                         if entry.name.endswith('.json') or (entry.is_dir() and not entry.name.startswith('.'))}
+            for stem in stems:
+                path = target._stem_file(class_dir, stem)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                if (shard / f'{stem}.json').exists():
+                    os.replace(shard / f'{stem}.json', path)
+                if (shard / stem).is_dir():
+                    os.replace(shard / stem, path.with_suffix(''))
+                    for related_class_dir in self._class_dirs(path.with_suffix('')):
+                        self._reshard_class(related_class_dir, target)
+        # Lock files and empty shards are left
+        shutil.rmtree(tmp)
 
     def __str__(self) -> str:
         return f'file.Storage(base_path={self.base_path})'
 
+    def close(self) -> None:
+        """
+        Stop threads reading model files.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
     def destroy(self) -> None:
+        self.close()
         shutil.rmtree(self.base_path)
@@ -0,0 +1,422 @@
+import bisect
+import os
+import re
+import shutil
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import Type, Any, Optional, Iterable, Union, List, Iterator, Dict, Set, Tuple, NamedTuple, BinaryIO
+
+from filelock import FileLock
+
+from .base import BaseStorage, StoredModel, Related, RawModel, class_key, decode_cursor, decode_model, decode_many, \
+    model_json
+
+# Record: CRC32 of the rest, key length, value length (-1 for tombstone), key, value
+_HEADER = struct.Struct('<IIi')
+_CRC = struct.Struct('<I')
+_LENGTHS = struct.Struct('<Ii')
+# Hint: key length, value length (-1 for tombstone), value offset, key
+_HINT = struct.Struct('<Iiq')
+_SEGMENT = re.compile(r'^(\d{8})(\.merged)?\.log$')
+
+
+class Location(NamedTuple):
+    """
+    Location of the latest value of a key: segment file name, offset and size of the value
+    """
+    segment: str
+    offset: int
+    size: int
+
+
+# Record written or read: key of models, model ID and value, None for tombstone
+_Record = Tuple[str, str, Optional[bytes]]
+
+
+class Storage(BaseStorage):
+    """
+    Log-structured storage in the Bitcask style. Models are appended to segment files, an in-memory
+    key directory keeps the location of the latest value of every model, deleted models are appended
+    as tombstones. Closed segments have hint files to rebuild the key directory without reading values.
+    Replaced and deleted values are dropped by `merge()`. Thread safe, the directory is used by one process.
+    """
+    base_path: Path
+
+    def __init__(self, base_path: Union[str, Path],
+                 max_segment_size: int = 64 << 20,
+                 merge_threshold: Optional[float] = 0.5,
+                 fsync: bool = False) -> None:
+        """
+        Directory of the storage files
+        :param base_path: base path.
+        :param max_segment_size: Size of the active segment in bytes from which a new one is started.
+        :param merge_threshold: Merge segments in a background thread when a segment is closed and replaced
+            and deleted values exceed this share of all segments, None to merge only by `merge()`.
+        :param fsync: Flush appended records to disk before the write returns.
+        """
+        self.base_path = base_path if isinstance(base_path, Path) else Path(base_path)
+        self.max_segment_size = max_segment_size
+        self.merge_threshold = merge_threshold
+        self.fsync = fsync
+        self.base_path.mkdir(parents=True, exist_ok=True)
+        self._process_lock = FileLock(self.base_path / 'LOCK')
+        self._process_lock.acquire(timeout=0)
+        self._lock = threading.RLock()
+        self._merge_lock = threading.Lock()
+        self._merger: Optional[threading.Thread] = None
+        # Key directory: locations of values by models key and model ID
+        self._keydir: Dict[str, Dict[str, Location]] = {}
+        # Keys of models related to a model by its key and ID, to delete them with the model
+        self._children: Dict[str, Set[str]] = {}
+        self._readers: Dict[str, BinaryIO] = {}
+        # Size and size of replaced and deleted records by segment
+        self._sizes: Dict[str, int] = {}
+        self._garbage: Dict[str, int] = {}
+        try:
+            self._open()
+        except BaseException:
+            self._process_lock.release()
+            raise
+
+    @staticmethod
+    def _encode(key: str, model_id: str, value: Optional[bytes]) -> Tuple[bytes, bytes]:
+        record_key = f'{key}\0{model_id}'.encode('utf-8')
+        body = _LENGTHS.pack(len(record_key), -1 if value is None else len(value)) + record_key + (value or b'')
+        return record_key, _CRC.pack(zlib.crc32(body)) + body
+
+    def _open(self) -> None:
+        """
+        Remove files left by an interrupted merge and rebuild the key directory from hints or segments.
+        """
+        segments = {}
+        for path in self.base_path.iterdir():
+            match = _SEGMENT.match(path.name)
+            if match:
+                segments[path.name] = (int(match.group(1)), bool(match.group(2)))
+            elif path.suffix == '.tmp':
+                path.unlink()
+        merged = max((number for number, is_merged in segments.values() if is_merged), default=0)
+        for name, (number, is_merged) in list(segments.items()):
+            # Segments merged into the latest merged segment are removed after it
+            if number < merged or (number == merged and not is_merged):
+                self._remove_segment(name)
+                del segments[name]
+        names = sorted(segments, key=lambda name: segments[name][0])
+        for name in names:
+            self._readers[name] = open(self.base_path / name, 'rb')
+            self._sizes[name] = os.path.getsize(self.base_path / name)
+            self._garbage[name] = 0
+            hint = self._hint_path(name)
+            if hint.exists():
+                hints = list(self._read_hints(hint))
+            else:
+                hints = list(self._scan_segment(name))
+                self._write_hints(name, hints)
+            for record_key, size, offset in hints:
+                key, model_id = record_key.decode('utf-8').split('\0')
+                self._apply(key, model_id, None if size < 0 else Location(name, offset, size), name, len(record_key))
+        self._active_number = segments[names[-1]][0] + 1 if names else 1
+        self._start_segment()
+
+    def _hint_path(self, name: str) -> Path:
+        return self.base_path / f'{name[:-len(".log")]}.hint'
+
+    def _remove_segment(self, name: str) -> None:
+        reader = self._readers.pop(name, None)
+        if reader is not None:
+            reader.close()
+        self._sizes.pop(name, None)
+        self._garbage.pop(name, None)
+        (self.base_path / name).unlink(missing_ok=True)
+        self._hint_path(name).unlink(missing_ok=True)
+
+    def _scan_segment(self, name: str) -> Iterator[Tuple[bytes, int, int]]:
+        """
+        Read records of a segment without hints. A torn record at the end, left by a crash, is truncated.
+        """
+        path = self.base_path / name
+        data = path.read_bytes()
+        offset = 0
+        while offset < len(data):
+            if offset + _HEADER.size > len(data):
+                break
+            crc, key_size, size = _HEADER.unpack_from(data, offset)
+            end = offset + _HEADER.size + key_size + max(size, 0)
+            if end > len(data) or zlib.crc32(data[offset + _CRC.size:end]) != crc:
+                break
+            value_offset = offset + _HEADER.size + key_size
+            yield data[offset + _HEADER.size:value_offset], size, value_offset
+            offset = end
+        if offset < len(data):
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+            self._sizes[name] = offset
+
+    @staticmethod
+    def _read_hints(path: Path) -> Iterator[Tuple[bytes, int, int]]:
+        data = path.read_bytes()
+        offset = 0
+        while offset < len(data):
+            key_size, size, value_offset = _HINT.unpack_from(data, offset)
+            offset += _HINT.size
+            yield data[offset:offset + key_size], size, value_offset
+            offset += key_size
+
+    def _write_hints(self, name: str, hints: Iterable[Tuple[bytes, int, int]]) -> None:
+        path = self._hint_path(name)
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            for record_key, size, offset in hints:
+                f.write(_HINT.pack(len(record_key), size, offset))
+                f.write(record_key)
+        os.replace(tmp, path)
+
+    def _start_segment(self) -> None:
+        self._active = f'{self._active_number:08}.log'
+        self._writer = open(self.base_path / self._active, 'ab')
+        self._readers[self._active] = open(self.base_path / self._active, 'rb')
+        self._sizes[self._active] = 0
+        self._garbage[self._active] = 0
+        self._active_hints: List[Tuple[bytes, int, int]] = []
+
+    def _rotate(self, merge: bool = True) -> None:
+        """
+        Close the active segment with its hint file and start a new one.
+        :param merge: Start merge in a background thread if there is too much garbage.
+        """
+        self._writer.close()
+        self._write_hints(self._active, self._active_hints)
+        self._active_number += 1
+        self._start_segment()
+        garbage = sum(self._garbage.values())
+        if merge and self.merge_threshold is not None and garbage > sum(self._sizes.values()) * self.merge_threshold \
+                and (self._merger is None or not self._merger.is_alive()):
+            self._merger = threading.Thread(target=self.merge, name='pys-merge', daemon=True)
+            self._merger.start()
+
+    def _apply(self, key: str, model_id: str, location: Optional[Location], segment: str, key_size: int) -> None:
+        """
+        Update the key directory by a record and count replaced values and tombstones as garbage.
+        """
+        models = self._keydir.get(key)
+        previous = models.pop(model_id, None) if models is not None else None
+        if previous is not None:
+            self._garbage[previous.segment] = self._garbage.get(previous.segment, 0) + \
+                _HEADER.size + key_size + previous.size
+        if location is None:
+            self._garbage[segment] += _HEADER.size + key_size
+            if models is not None and not models:
+                self._drop_key(key)
+            return
+        if models is None:
+            models = self._keydir[key] = {}
+            parent, _, _ = key.rpartition('/')
+            if parent:
+                self._children.setdefault(parent, set()).add(key)
+        models[model_id] = location
+
+    def _drop_key(self, key: str) -> None:
+        del self._keydir[key]
+        parent, _, _ = key.rpartition('/')
+        children = self._children.get(parent)
+        if children is not None:
+            children.discard(key)
+            if not children:
+                del self._children[parent]
+
+    def _append(self, records: List[_Record]) -> None:
+        """
+        Append records at once and apply them to the key directory.
+        """
+        with self._lock:
+            content = bytearray()
+            applied = []
+            for key, model_id, value in records:
+                record_key, record = self._encode(key, model_id, value)
+                offset = self._sizes[self._active] + len(content) + _HEADER.size + len(record_key)
+                content += record
+                applied.append((key, model_id, None if value is None else Location(self._active, offset, len(value)),
+                                record_key))
+            self._writer.write(content)
+            self._writer.flush()
+            if self.fsync:
+                os.fsync(self._writer.fileno())
+            self._sizes[self._active] += len(content)
+            for key, model_id, location, record_key in applied:
+                self._active_hints.append((record_key, -1 if location is None else location.size,
+                                           location.offset if location is not None else 0))
+                self._apply(key, model_id, location, self._active, len(record_key))
+            if self._sizes[self._active] >= self.max_segment_size:
+                self._rotate()
+
+    def _read(self, location: Location) -> bytes:
+        reader = self._readers[location.segment]
+        if hasattr(os, 'pread'):
+            return os.pread(reader.fileno(), location.size, location.offset)
+        reader.seek(location.offset)
+        return reader.read(location.size)
+
+    def _get(self, key: str, model_id: str) -> Optional[bytes]:
+        with self._lock:
+            location = self._keydir.get(key, {}).get(model_id)
+            return self._read(location) if location is not None else None
+
+    def _tombstones(self, key: str, model_id: str, records: List[_Record]) -> None:
+        if model_id in self._keydir.get(key, ()):
+            records.append((key, model_id, None))
+        # Models related to the deleted one are deleted with it
+        for child in self._children.get(f'{key}/{model_id}', ()):
+            for child_id in self._keydir.get(child, ()):
+                self._tombstones(child, child_id, records)
+
+    def merge(self) -> None:
+        """
+        Rewrite the latest values of all closed segments to one segment dropping replaced and deleted values.
+        Writes are not blocked while values are copied.
+        """
+        with self._merge_lock:
+            with self._lock:
+                if not any(self._garbage.values()) and not self._sizes[self._active] and len(self._sizes) <= 2:
+                    # Nothing to drop or join
+                    return
+                # The active segment is merged too, the merged segment takes its number
+                self._rotate(merge=False)
+                merged = [name for name in self._sizes if name != self._active]
+                live = [(key, model_id, location) for key, models in self._keydir.items()
+                        for model_id, location in models.items() if location.segment != self._active]
+                name = f'{self._active_number - 1:08}.merged.log'
+            tmp = self.base_path / f'{name}.tmp'
+            hints = []
+            locations = []
+            with open(tmp, 'wb') as f:
+                offset = 0
+                for key, model_id, location in live:
+                    with self._lock:
+                        value = self._read(location)
+                    record_key, record = self._encode(key, model_id, value)
+                    f.write(record)
+                    hints.append((record_key, len(value), offset + _HEADER.size + len(record_key)))
+                    locations.append(Location(name, offset + _HEADER.size + len(record_key), len(value)))
+                    offset += len(record)
+                f.flush()
+                os.fsync(f.fileno())
+            with self._lock:
+                # The merged segment replaces merged ones from now on, even if the process is interrupted
+                os.replace(tmp, self.base_path / name)
+                self._write_hints(name, hints)
+                self._readers[name] = open(self.base_path / name, 'rb')
+                self._sizes[name] = offset
+                self._garbage[name] = 0
+                for (key, model_id, location), merged_location, (record_key, _, _) in zip(live, locations, hints):
+                    models = self._keydir.get(key)
+                    if models is not None and models.get(model_id) == location:
+                        models[model_id] = merged_location
+                    else:
+                        # Replaced or deleted while merging
+                        self._garbage[name] += _HEADER.size + len(record_key) + merged_location.size
+                for segment in merged:
+                    self._remove_segment(segment)
+
+    def load(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> Optional[StoredModel]:
+        raw_content = self._get(class_key(model_class, *related_model), str(model_id))
+        return decode_model(model_class, raw_content, model_id) if raw_content is not None else None
+
+    def save(self, model: StoredModel, *related_model: Related) -> Any:
+        model_id = model.__my_id__()
+        self._append([(class_key(model.__class__, *related_model), str(model_id), model_json(model))])
+        return model_id
+
+    def delete(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> None:
+        self.delete_many(model_class, [model_id], *related_model)
+
+    def save_many(self, models: Iterable[StoredModel], *related_model: Related) -> List[Any]:
+        ids = []
+        records = []
+        for model in models:
+            model_id = model.__my_id__()
+            records.append((class_key(model.__class__, *related_model), str(model_id), model_json(model)))
+            ids.append(model_id)
+        self._append(records)
+        return ids
+
+    def load_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                  *related_model: Related) -> List[Optional[StoredModel]]:
+        key = class_key(model_class, *related_model)
+        model_ids = list(model_ids)
+        raw_contents = [self._get(key, str(model_id)) for model_id in model_ids]
+        found = [(model_id, raw_content) for model_id, raw_content in zip(model_ids, raw_contents)
+                 if raw_content is not None]
+        models = iter(decode_many(model_class, found))
+        return [next(models) if raw_content is not None else None for raw_content in raw_contents]
+
+    def delete_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                    *related_model: Related) -> None:
+        key = class_key(model_class, *related_model)
+        with self._lock:
+            records = []
+            for model_id in model_ids:
+                self._tombstones(key, str(model_id), records)
+            if records:
+                self._append(records)
+
+    def _ids(self, model_class: Type[StoredModel], *related_model: Related,
+             limit: Optional[int] = None, after: Optional[str] = None) -> List[str]:
+        with self._lock:
+            ids = sorted(self._keydir.get(class_key(model_class, *related_model), ()))
+        if after is not None:
+            ids = ids[bisect.bisect_right(ids, after):]
+        return ids if limit is None else ids[:limit]
+
+    def _iter_raw(self, model_class: Type[StoredModel],
+                  *related_model: Related,
+                  limit: Optional[int] = None,
+                  after: Optional[str] = None) -> Iterator[RawModel]:
+        key = class_key(model_class, *related_model)
+        for model_id in self._ids(model_class, *related_model, limit=limit, after=after):
+            # Values are looked up again, they may be moved by merge or deleted while listing
+            raw_content = self._get(key, model_id)
+            if raw_content is not None:
+                yield model_id, raw_content
+
+    def list_ids(self, model_class: Type[StoredModel],
+                 *related_model: Related,
+                 limit: Optional[int] = None,
+                 after: Optional[str] = None) -> Iterator[Any]:
+        return iter(self._ids(model_class, *related_model, limit=limit, after=decode_cursor(after)))
+
+    def count(self, model_class: Type[StoredModel], *related_model: Related) -> int:
+        with self._lock:
+            return len(self._keydir.get(class_key(model_class, *related_model), ()))
+
+    def exists(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> bool:
+        with self._lock:
+            return str(model_id) in self._keydir.get(class_key(model_class, *related_model), ())
+
+    def __str__(self) -> str:
+        return f'log.Storage(base_path={self.base_path})'
+
+    def close(self) -> None:
+        """
+        Wait for a running merge, write hints of the active segment and release the storage directory.
+        """
+        merger = self._merger
+        if merger is not None:
+            merger.join()
+        with self._lock:
+            if self._writer.closed:
+                return
+            self._writer.close()
+            for reader in self._readers.values():
+                reader.close()
+            self._readers.clear()
+            if self._sizes[self._active]:
+                self._write_hints(self._active, self._active_hints)
+            else:
+                (self.base_path / self._active).unlink()
+            self._process_lock.release()
+
+    def destroy(self) -> None:
+        self.close()
+        shutil.rmtree(self.base_path)
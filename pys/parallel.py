@@ -0,0 +1,95 @@
+import collections
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Type, Optional, Iterator, List, Deque
+
+from .base import BaseStorage, StoredModel, Related, RawModel, decode_cursor, decode_many
+
+
+def _decode_chunk(model_class: Type[StoredModel], raw_models: List[RawModel]) -> List[StoredModel]:
+    return decode_many(model_class, raw_models)
+
+
+class ParallelLoader:
+    """
+    Decode listed models in worker processes, for lists of many models that are slow to create
+    (e.g. Pydantic models), while the storage is read in the calling process. Model classes shall be
+    importable by worker processes: defined at module level, not in a function.
+    """
+    def __init__(self, storage: BaseStorage,
+                 workers: Optional[int] = None,
+                 chunk_size: int = 1024,
+                 threshold: int = 10_000) -> None:
+        """
+        Decode models listed from the storage in worker processes.
+        :param storage: Storage to list models from.
+        :param workers: Number of worker processes, None for the number of CPUs.
+        :param chunk_size: Number of models decoded at once by a worker process.
+        :param threshold: Lists of fewer models are decoded in the calling process.
+        """
+        self.storage = storage
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.threshold = threshold
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def list(self, model_class: Type[StoredModel],
+             *related_model: Related,
+             limit: Optional[int] = None,
+             after: Optional[str] = None) -> Iterator[StoredModel]:
+        """
+        List models ordered by ID as `BaseStorage.list()` does.
+        :param model_class: Model class
+        :param related_model: Related model(s) -- model that the listed models are belong to.
+        :param limit: Maximum number of models to list.
+        :param after: Cursor made by `cursor()` to continue listing after.
+        :return: Iterator over found models.
+        """
+        raw_models = (self._picklable(raw_model) for raw_model in
+                      self.storage._iter_raw(model_class, *related_model, limit=limit, after=decode_cursor(after)))
+        head = list(itertools.islice(raw_models, self.threshold))
+        if len(head) < self.threshold:
+            yield from decode_many(model_class, head)
+            return
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        # Chunks are decoded in order, a few of them ahead per worker to keep workers busy and memory bounded
+        chunks = self._chunks(itertools.chain(head, raw_models))
+        pending: Deque[Future] = collections.deque()
+        try:
+            for chunk in itertools.islice(chunks, self.workers * 2):
+                pending.append(self._pool.submit(_decode_chunk, model_class, chunk))
+            while pending:
+                models = pending.popleft().result()
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    pending.append(self._pool.submit(_decode_chunk, model_class, chunk))
+                yield from models
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _chunks(self, raw_models: Iterator[RawModel]) -> Iterator[List[RawModel]]:
+        while chunk := list(itertools.islice(raw_models, self.chunk_size)):
+            yield chunk
+
+    @staticmethod
+    def _picklable(raw_model: RawModel) -> RawModel:
+        # Memory maps of model files are not passed to other processes
+        model_id, content = raw_model
+        return (model_id, bytes(content)) if isinstance(content, memoryview) else raw_model
+
+    def close(self) -> None:
+        """
+        Stop worker processes.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self) -> 'ParallelLoader':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,174 @@
+import operator
+from typing import Any, Tuple, Optional, Type, Iterator, NamedTuple, List, Callable
+
+import msgspec
+
+from .base import StoredModel, Related, RawModel, field_value, json_fields
+
+OPERATORS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda value, expected: value in expected,
+    'not in': lambda value, expected: value not in expected,
+}
+
+
+class Condition(NamedTuple):
+    """
+    Condition on a model field: `field op value`
+    """
+    field: str
+    op: str
+    value: Any
+
+
+class Order(NamedTuple):
+    """
+    Ordering by a model field
+    """
+    field: str
+    descending: bool
+
+
+def _valid_field(name: str) -> str:
+    if not name.isidentifier():
+        raise ValueError(f'Wrong field name: {name}')
+    return name
+
+
+def _sort_value(value: Any) -> Tuple[int, Any]:
+    # Values of different types are ordered as SQLite orders JSON values: missing values (NULLs) first,
+    # then numbers (booleans are 0 and 1), then strings with JSON arrays and objects compared by their text
+    if value is None:
+        return 0, 0
+    if isinstance(value, (bool, int, float)):
+        return 1, value
+    if isinstance(value, str):
+        return 2, value
+    return 2, msgspec.json.encode(value).decode('utf-8')
+
+
+def _sort_key(name: str) -> Callable[[Tuple[dict, RawModel]], Any]:
+    def key(item: Tuple[dict, RawModel]) -> Any:
+        return _sort_value(item[0].get(name))
+    return key
+
+
+class Query:
+    """
+    Query over models of a class: filter by field values, order and limit. Create it with `storage.query()`,
+    iterate it to get found models. Query methods return a new query.
+    """
+    def __init__(self, storage, model_class: Type[StoredModel], *related_model: Related) -> None:
+        self.storage = storage
+        self.model_class = model_class
+        self.related_model = related_model
+        self.conditions: Tuple[Condition, ...] = ()
+        self.ordering: Tuple[Order, ...] = ()
+        self.max_count: Optional[int] = None
+
+    def _copy(self, **changes: Any) -> 'Query':
+        query = Query(self.storage, self.model_class, *self.related_model)
+        query.conditions = self.conditions
+        query.ordering = self.ordering
+        query.max_count = self.max_count
+        for name, value in changes.items():
+            setattr(query, name, value)
+        return query
+
+    def where(self, *condition: Any, **fields: Any) -> 'Query':
+        """
+        Filter models: `where('year', '>=', 1860)` or `where(status='published')` for equality.
+        Supported operators: `=`, `!=`, `<`, `<=`, `>`, `>=`, `in`, `not in`.
+        :param condition: Field name, operator and value.
+        :param fields: Field names with expected values.
+        :return: New query.
+        """
+        conditions = list(self.conditions)
+        if condition:
+            (name, op, value) = condition
+            if op not in OPERATORS:
+                raise ValueError(f'Unsupported operator: {op}')
+            if op in ('in', 'not in'):
+                value = tuple(field_value(v, self.model_class) for v in value)
+            else:
+                value = field_value(value, self.model_class)
+            conditions.append(Condition(_valid_field(name), '=' if op == '==' else op, value))
+        for name, value in fields.items():
+            conditions.append(Condition(_valid_field(name), '=', field_value(value, self.model_class)))
+        return self._copy(conditions=tuple(conditions))
+
+    def order_by(self, *fields: str) -> 'Query':
+        """
+        Order models by fields, `-field` for descending order. Models with equal fields are ordered by ID.
+        :param fields: Field names.
+        :return: New query.
+        """
+        ordering = tuple(Order(_valid_field(name.lstrip('-')), name.startswith('-')) for name in fields)
+        return self._copy(ordering=self.ordering + ordering)
+
+    def limit(self, count: int) -> 'Query':
+        """
+        Limit number of found models.
+        :param count: Maximum number of models.
+        :return: New query.
+        """
+        return self._copy(max_count=count)
+
+    def matches(self, fields: dict) -> bool:
+        """
+        Check the query conditions on field values of a model.
+        :param fields: Field values as they are in JSON.
+        :return: True if all conditions are met.
+        """
+        for condition in self.conditions:
+            value = fields.get(condition.field)
+            # Missing values behave as NULLs in SQL: only `= None` and `!= None` are checked on them
+            if condition.value is None and condition.op in ('=', '!='):
+                if (value is None) != (condition.op == '='):
+                    return False
+            elif value is None:
+                return False
+            else:
+                try:
+                    if not OPERATORS[condition.op](value, condition.value):
+                        return False
+                except TypeError:
+                    # Values are not comparable, e.g. a string with a number
+                    return False
+        return True
+
+    def evaluate(self, raw_models: Iterator[RawModel]) -> Iterator[RawModel]:
+        """
+        Evaluate the query over raw JSON content of models ordered by ID without creating models.
+        :param raw_models: Iterator over (model ID, raw content) pairs ordered by ID.
+        :return: Iterator over matching (model ID, raw content) pairs.
+        """
+        if not self.ordering:
+            count = 0
+            for raw_model in raw_models:
+                if self.max_count is not None and count >= self.max_count:
+                    return
+                if self.matches(json_fields(raw_model[1])):
+                    count += 1
+                    yield raw_model
+            return
+
+        found: List[Tuple[dict, RawModel]] = []
+        for raw_model in raw_models:
+            fields = json_fields(raw_model[1])
+            if self.matches(fields):
+                found.append((fields, raw_model))
+        # Stable sorts from the last field to the first one keep ID order for equal values
+        for order in reversed(self.ordering):
+            found.sort(key=_sort_key(order.field), reverse=order.descending)
+        for _, raw_model in found[:self.max_count]:
+            yield raw_model
+
+    def __iter__(self) -> Iterator[StoredModel]:
+        return iter(self.storage._execute_query(self))
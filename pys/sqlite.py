@@ -1,41 +1,365 @@
+import itertools
 import os
 import re
 import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-from typing import Type, Iterable, Optional, Any
+from typing import Type, Iterable, Optional, Any, List, Dict, NamedTuple, Iterator, Tuple, Set
 
-from .base import BaseStorage, StoredModel, Related
+import msgspec
+
+from .base import BaseStorage, StoredModel, Related, RawModel, decode_many, model_indexes, decode_cursor, \
+    decode_model, model_json
+from .query import Query
+
+
+class _Statements(NamedTuple):
+    """
+    SQL text prepared for a model class table
+    """
+    table_name: str
+    load: str
+    load_related: str
+    insert: str
+    delete: str
+    delete_related: str
+    list: str
+    list_related: str
+    list_ids: str
+    list_ids_related: str
+    count: str
+    count_related: str
+    exists: str
+    exists_related: str
+
+    @classmethod
+    def build(cls, table_name: str) -> '_Statements':
+        related = 'related_id=? and related_name=?'
+        root = 'related_id is null'
+        # JSON is stored as text for JSON functions, but read as blob to pass bytes to models without decoding
+        columns = 'id, cast(data as blob)'
+        return cls(
+            table_name=table_name,
+            load=f'select {columns} from {table_name} where id=? and {root}',
+            load_related=f'select {columns} from {table_name} where id=? and {related}',
+            insert=f"""
+                insert into {table_name} (id, data, related_id, related_name)
+                values (?, cast(? as text), ?, ?) 
+                on conflict do update set data=excluded.data;
+                """,
+            delete=f'delete from {table_name} where id=? and {root}',
+            delete_related=f'delete from {table_name} where id=? and {related}',
+            list=f'select {columns} from {table_name} where {root} and id > ? order by id limit ?',
+            list_related=f'select {columns} from {table_name} where {related} and id > ? order by id limit ?',
+            list_ids=f'select id from {table_name} where {root} and id > ? order by id limit ?',
+            list_ids_related=f'select id from {table_name} where {related} and id > ? order by id limit ?',
+            count=f'select count(*) from {table_name} where {root}',
+            count_related=f'select count(*) from {table_name} where {related}',
+            exists=f'select 1 from {table_name} where id=? and {root} limit 1',
+            exists_related=f'select 1 from {table_name} where id=? and {related} limit 1',
+        )
+
+
+class _Reader:
+    """
+    Read connection of a thread, it is closed when the thread exits and its locals are released
+    """
+    __slots__ = ('con', '__weakref__')
+
+    def __init__(self, con: sqlite3.Connection) -> None:
+        self.con = con
+
+
+def _close_reader(lock: threading.RLock, readers: List[sqlite3.Connection], con: sqlite3.Connection) -> None:
+    with lock:
+        if con in readers:
+            readers.remove(con)
+    con.close()
 
 
 class Storage(BaseStorage):
     con = None
 
     def _ensure_table_exist(self, table_name):
-        for cnt in self.con.execute(
-                "select count(name) from sqlite_master where type='table' and name=?;",
-                (table_name,)
-        ):
-            if not cnt[0] == 1:
-                self.con.execute(
-                    f"""
-                    create table {table_name} (
-                        id varchar(255) not null,
-                        data json,
-                        related_id varchar(255),
-                        related_name varchar(255),
-                        unique (id, related_id, related_name)
-                    );
-
-                    """
-                )
+        self.con.execute(
+            f"""
+            create table if not exists {table_name} (
+                id varchar(255) not null,
+                data json,
+                related_id varchar(255),
+                related_name varchar(255),
+                unique (id, related_id, related_name)
+            );
+            """
+        )
+        self.con.execute(
+            f'create index if not exists {table_name}_related on {table_name} (related_name, related_id, id)')
+        try:
+            self.con.execute(
+                f'create unique index if not exists {table_name}_root on {table_name} (id) where related_id is null')
+        except sqlite3.IntegrityError as e:
+            # Root models were duplicated on re-save before the index existed, the user decides what to keep
+            raise sqlite3.IntegrityError(
+                f'Table {table_name} has duplicated root models saved by an older version, '
+                f'call deduplicate() to keep the latest saved ones') from e
+
+    @staticmethod
+    def _json_field(name: str) -> str:
+        if not name.isidentifier():
+            raise ValueError(f'Wrong field name: {name}')
+        return f"json_extract(data, '$.{name}')"
+
+    def _ensure_index_exist(self, table_name: str, index: Tuple[str, ...]):
+        self.con.execute(
+            f"""
+            create index if not exists {table_name}__{'__'.join(index)}
+            on {table_name} (related_id, {', '.join(self._json_field(name) for name in index)}, id)
+            """
+        )
 
     @staticmethod
     def _get_table_name(cls):
         return re.sub(r'\W', '_', cls.__name__).lower()
 
-    def __init__(self, path: Path):
+    def _sql(self, model_class: Type[StoredModel]) -> _Statements:
+        """
+        Get cached statements of the model class table, the table is created on the first use.
+        """
+        try:
+            return self._statements[model_class]
+        except KeyError:
+            table_name = self._get_table_name(model_class)
+            with self._lock:
+                self._retry(self._ensure_table_exist, table_name)
+                for index in model_indexes(model_class):
+                    self._retry(self._ensure_index_exist, table_name, index)
+            statements = self._statements[model_class] = _Statements.build(table_name)
+            return statements
+
+    def deduplicate(self, model_class: Type[StoredModel]) -> int:
+        """
+        Delete root models duplicated by re-saves of older versions of the storage, the latest saved ones are kept.
+        :param model_class: Model class.
+        :return: Number of deleted models.
+        """
+        table_name = self._get_table_name(model_class)
+        with self.transaction():
+            deleted = self.con.execute(
+                f"""
+                delete from {table_name}
+                where related_id is null and rowid not in (
+                    select max(rowid) from {table_name} where related_id is null group by id
+                )
+                """
+            ).rowcount
+        self._statements.pop(model_class, None)
+        return deleted
+
+    def invalidate_schema_cache(self) -> None:
+        """
+        Forget known tables and prepared statements, e.g. after the schema is changed outside the storage.
+        """
+        self._statements.clear()
+
+    def __init__(self, path: Path,
+                 journal_mode: str = 'wal',
+                 synchronous: str = 'normal',
+                 commit_every: int = 1,
+                 commit_interval: Optional[float] = None,
+                 thread_safe: bool = False,
+                 busy_timeout: float = 5.0,
+                 retries: int = 5,
+                 retry_backoff: float = 0.01):
+        """
+        SQLite based storage.
+        :param path: Path to the database file.
+        :param journal_mode: SQLite journal mode, `wal` by default.
+        :param synchronous: SQLite `synchronous` mode: `off`, `normal`, `full` or `extra`.
+        :param commit_every: Outside of `transaction()` commit after this number of writes.
+        :param commit_interval: Outside of `transaction()` commit once the oldest uncommitted write is
+        older than this number of seconds. The interval is checked by writes and reads, there is no timer:
+        pending writes of an idle storage (and the write lock) are kept until the next operation, `commit()`
+        or `close()`.
+        :param thread_safe: Allow using the storage from many threads: every thread reads with its own
+        connection, writes are serialised through one writer connection. Reads of other threads see committed
+        data only.
+        :param busy_timeout: Seconds to wait for a lock held by another connection or process.
+        :param retries: How many times to retry an operation failed with a busy database.
+        :param retry_backoff: Initial delay between retries in seconds, doubled on every retry.
+        """
         self.base_path = Path(path)
-        self.con = sqlite3.connect(self.base_path)
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.thread_safe = thread_safe
+        self.busy_timeout = busy_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._pending = 0
+        self._pending_since = 0.0
+        # Threads that made pending writes, they read them with the writer connection
+        self._pending_writers: Set[int] = set()
+        self._tx_depth = 0
+        self._tx_owner = None
+        self._statements: Dict[Type[StoredModel], _Statements] = {}
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self.con = self._connect()
+        self.con.execute(f'pragma journal_mode={journal_mode}')
+        self.con.execute(f'pragma synchronous={synchronous}')
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.base_path, isolation_level=None, timeout=self.busy_timeout,
+                               check_same_thread=not self.thread_safe)
+
+    def _reader(self) -> sqlite3.Connection:
+        """
+        Get connection for reading: the writer connection in single thread mode, inside of transaction
+        or for a thread with pending writes, a connection of the current thread otherwise.
+        """
+        thread_id = threading.get_ident()
+        if not self.thread_safe or (self._tx_depth and self._tx_owner == thread_id) \
+                or thread_id in self._pending_writers:
+            return self.con
+        reader = getattr(self._local, 'reader', None)
+        if reader is None:
+            con = self._connect()
+            con.execute('pragma query_only=1')
+            reader = self._local.reader = _Reader(con)
+            with self._lock:
+                self._readers.append(con)
+            # The storage is not referenced, so it is not kept alive by threads that used it
+            weakref.finalize(reader, _close_reader, self._lock, self._readers, con)
+        return reader.con
+
+    @staticmethod
+    def _is_busy(e: sqlite3.OperationalError) -> bool:
+        message = str(e)
+        return 'locked' in message or 'busy' in message
+
+    def _retry(self, fn, *args):
+        for attempt in range(self.retries):
+            try:
+                return fn(*args)
+            except sqlite3.OperationalError as e:
+                if not self._is_busy(e):
+                    raise
+                time.sleep(self.retry_backoff * 2 ** attempt)
+        return fn(*args)
+
+    def _read(self, sql: str, params: tuple):
+        if self._pending and self.commit_interval is not None:
+            # Reads commit expired writes as well, so a burst of writes followed by reads is committed in time
+            with self._lock:
+                if self._pending and self._commit_due():
+                    self.commit()
+        con = self._reader()
+        try:
+            if self.thread_safe and con is self.con:
+                # The writer connection is shared by threads, rows are fetched at once under the lock
+                with self._lock:
+                    return self._retry(con.execute, sql, params).fetchall()
+            return self._retry(con.execute, sql, params)
+        except sqlite3.OperationalError as e:
+            # The table is created by another thread and is not committed yet
+            if 'no such table' in str(e):
+                return []
+            raise
+
+    def _begin(self) -> None:
+        self._retry(self.con.execute, 'begin immediate')
+
+    def commit(self) -> None:
+        """
+        Commit pending autocommit writes. Does nothing inside of `transaction()`.
+        """
+        with self._lock:
+            if not self._tx_depth and self.con.in_transaction:
+                self._retry(self.con.commit)
+            self._pending = 0
+            self._pending_writers.clear()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run writes in one transaction: it is committed on exit and rolled back on exception.
+        Nested transactions are savepoints of the outer one. Other threads wait for the transaction
+        to finish before writing.
+        """
+        with self._lock:
+            if self._tx_depth:
+                savepoint = f'sp{self._tx_depth}'
+                self._tx_depth += 1
+                try:
+                    with self._savepoint(savepoint):
+                        yield self
+                finally:
+                    self._tx_depth -= 1
+                return
+
+            self.commit()
+            self._begin()
+            self._tx_depth = 1
+            self._tx_owner = threading.get_ident()
+            try:
+                yield self
+            except BaseException:
+                self._tx_depth = 0
+                self._rollback()
+                raise
+            finally:
+                self._tx_owner = None
+            self._tx_depth = 0
+            self._retry(self.con.commit)
+
+    def _rollback(self) -> None:
+        # Tables created in the rolled back transaction are gone as well
+        self.con.rollback()
+        self._pending = 0
+        self._pending_writers.clear()
+        self.invalidate_schema_cache()
+
+    @contextmanager
+    def _savepoint(self, name: str):
+        self.con.execute(f'savepoint {name}')
+        try:
+            yield
+        except BaseException:
+            self.con.execute(f'rollback to {name}')
+            self.con.execute(f'release {name}')
+            self.invalidate_schema_cache()
+            raise
+        self.con.execute(f'release {name}')
+
+    @contextmanager
+    def _write(self, count: int = 1):
+        with self._lock:
+            if not self._tx_depth and not self.con.in_transaction:
+                self._begin()
+                self._pending_since = time.monotonic()
+            # A failed write is rolled back alone, without pending writes of the transaction or the commit group.
+            # The first write of an autocommit transaction is rolled back with the whole transaction.
+            isolated = self._tx_depth or self._pending
+            try:
+                with self._savepoint('write') if isolated else nullcontext():
+                    yield
+            except BaseException:
+                if not isolated:
+                    self._rollback()
+                raise
+            if self._tx_depth:
+                return
+            self._pending += count
+            self._pending_writers.add(threading.get_ident())
+            if self._commit_due():
+                self.commit()
+
+    def _commit_due(self) -> bool:
+        return self._pending >= self.commit_every or (
+            self.commit_interval is not None and time.monotonic() - self._pending_since >= self.commit_interval)
 
     @staticmethod
     def _related(related_model: Related):
@@ -50,36 +374,22 @@ class Storage(BaseStorage):
     def load(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> Optional[StoredModel]:
         last_related = related_model[-1] if related_model else None
         (rel_cls, rel_id) = self._related(last_related)
+        sql = self._sql(model_class)
 
-        table_name = self._get_table_name(model_class)
-        self._ensure_table_exist(table_name)
-
-        for row in self.con.execute(
-            f"""
-            select id, data, related_id, related_name
-            from {table_name}
-            where 
-                id=? and {'related_id=? and related_name=?' if rel_id else 'related_id is null'}
-            """,
-            (model_id, rel_id, rel_cls.__name__) if last_related else (model_id,),
+        for row in self._read(
+            sql.load_related if rel_cls else sql.load,
+            (model_id, rel_id, rel_cls.__name__) if rel_cls else (model_id,),
         ):
-            return model_class.__factory__(row[1], row[0])
+            return decode_model(model_class, row[1], row[0])
         else:
             return None
 
     def _save(self, model: StoredModel, prev=Related):
-        table_name = self._get_table_name(model.__class__)
-        self._ensure_table_exist(table_name)
-
         (prev_cls, prev_id) = self._related(prev)
         self.con.execute(
-            f"""
-            insert into {table_name} (id, data, related_id, related_name)
-            values (?, ?, ?, ?) 
-            on conflict do update set data=excluded.data;
-            """,
+            self._sql(model.__class__).insert,
             (model.__my_id__(),
-             model.__json__(),
+             model_json(model),
              prev_id,
              prev_cls.__name__ if prev else None,),
         )
@@ -88,46 +398,223 @@ class Storage(BaseStorage):
     def save(self, model: StoredModel, *related_model: Related) -> Any:
         prev_model = None
         last_id = None
-        for m in related_model + (model,):
-            last_id = self._save(m, prev=prev_model)
-            prev_model = m
+        with self._write():
+            for m in related_model + (model,):
+                last_id = self._save(m, prev=prev_model)
+                prev_model = m
         return last_id
 
     def delete(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> None:
         last_related = related_model[-1] if related_model else None
         (prev_cls, prev_id) = self._related(last_related)
 
-        table_name = self._get_table_name(model_class)
-        self._ensure_table_exist(table_name)
+        sql = self._sql(model_class)
 
-        self.con.execute(
-            f"""
-            delete from {table_name}
-            where id=? and related_id=? and related_name=? 
-            """,
-            (str(model_id), prev_id, prev_cls.__name__ if prev_cls else None,)
-        )
+        with self._write():
+            self.con.execute(
+                sql.delete_related if prev_cls else sql.delete,
+                (str(model_id), prev_id, prev_cls.__name__) if prev_cls else (str(model_id),)
+            )
+
+    def save_many(self, models: Iterable[StoredModel], *related_model: Related) -> List[Any]:
+        models = list(models)
+        if not models:
+            # Nothing to count to the commit group, so no transaction is left open
+            return []
+        ids = []
+        with self._write(len(models)):
+            prev_model = None
+            for m in related_model:
+                self._save(m, prev=prev_model)
+                prev_model = m
+            (prev_cls, prev_id) = self._related(prev_model)
+
+            rows_by_class: Dict[Type[StoredModel], list] = {}
+            for model in models:
+                model_id = model.__my_id__()
+                ids.append(model_id)
+                rows_by_class.setdefault(model.__class__, []).append(
+                    (model_id, model_json(model), prev_id, prev_cls.__name__ if prev_cls else None))
+
+            for model_class, rows in rows_by_class.items():
+                self.con.executemany(self._sql(model_class).insert, rows)
+        return ids
+
+    _MAX_VARIABLES = 900
+
+    def load_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                  *related_model: Related) -> List[Optional[StoredModel]]:
+        model_ids = list(model_ids)
+        last_related = related_model[-1] if related_model else None
+        (rel_cls, rel_id) = self._related(last_related)
 
-    def list(self, model_class: Type[StoredModel], *related_model: Related) -> Iterable[StoredModel]:
+        table_name = self._sql(model_class).table_name
+
+        rows: List[RawModel] = []
+        for start in range(0, len(model_ids), self._MAX_VARIABLES):
+            chunk = model_ids[start:start + self._MAX_VARIABLES]
+            rows += self._read(
+                f"""
+                select id, cast(data as blob)
+                from {table_name}
+                where 
+                    id in ({','.join('?' * len(chunk))}) and 
+                    {'related_id=? and related_name=?' if rel_cls else 'related_id is null'}
+                """,
+                (*chunk, rel_id, rel_cls.__name__) if rel_cls else tuple(chunk),
+            )
+        found = {row[0]: model for row, model in zip(rows, decode_many(model_class, rows))}
+        return [found.get(str(model_id)) for model_id in model_ids]
+
+    def delete_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                    *related_model: Related) -> None:
         last_related = related_model[-1] if related_model else None
         (prev_cls, prev_id) = self._related(last_related)
 
-        table_name = self._get_table_name(model_class)
-        self._ensure_table_exist(table_name)
+        sql = self._sql(model_class)
+
+        model_ids = list(model_ids)
+        if not model_ids:
+            return
+        with self._write(len(model_ids)):
+            self.con.executemany(
+                sql.delete_related if prev_cls else sql.delete,
+                ((str(model_id), prev_id, prev_cls.__name__) if prev_cls else (str(model_id),)
+                 for model_id in model_ids)
+            )
+
+    fetch_size = 256
+
+    def _pages(self, statement: str, params: tuple, after: Optional[str], limit: Optional[int]) -> Iterator[tuple]:
+        """
+        Read rows of a list statement by pages of `fetch_size` rows, IDs are the first column. No cursor is kept
+        between pages, so writes (and their rollbacks) while iterating do not abort the iteration.
+        """
+        after = '' if after is None else after
+        while limit is None or limit > 0:
+            size = self.fetch_size if limit is None else min(self.fetch_size, limit)
+            rows = list(self._read(statement, (*params, after, size)))
+            yield from rows
+            if len(rows) < size:
+                return
+            if limit is not None:
+                limit -= len(rows)
+            after = rows[-1][0]
 
-        return [model_class.__factory__(row[1], row[0]) for row in self.con.execute(
+    def _iter_raw(self, model_class: Type[StoredModel],
+                  *related_model: Related,
+                  limit: Optional[int] = None,
+                  after: Optional[str] = None) -> Iterator[RawModel]:
+        last_related = related_model[-1] if related_model else None
+        (prev_cls, prev_id) = self._related(last_related)
+        sql = self._sql(model_class)
+
+        return self._pages(sql.list_related if prev_cls else sql.list,
+                           (prev_id, prev_cls.__name__) if prev_cls else (), after, limit)
+
+    def list_ids(self, model_class: Type[StoredModel],
+                 *related_model: Related,
+                 limit: Optional[int] = None,
+                 after: Optional[str] = None) -> Iterator[Any]:
+        last_related = related_model[-1] if related_model else None
+        (prev_cls, prev_id) = self._related(last_related)
+        sql = self._sql(model_class)
+
+        rows = self._pages(sql.list_ids_related if prev_cls else sql.list_ids,
+                           (prev_id, prev_cls.__name__) if prev_cls else (), decode_cursor(after), limit)
+        return (row[0] for row in rows)
+
+    def count(self, model_class: Type[StoredModel], *related_model: Related) -> int:
+        last_related = related_model[-1] if related_model else None
+        (prev_cls, prev_id) = self._related(last_related)
+        sql = self._sql(model_class)
+
+        for row in self._read(
+            sql.count_related if prev_cls else sql.count,
+            (prev_id, prev_cls.__name__) if prev_cls else (),
+        ):
+            return row[0]
+        return 0
+
+    def exists(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> bool:
+        last_related = related_model[-1] if related_model else None
+        (prev_cls, prev_id) = self._related(last_related)
+        sql = self._sql(model_class)
+
+        for _ in self._read(
+            sql.exists_related if prev_cls else sql.exists,
+            (model_id, prev_id, prev_cls.__name__) if prev_cls else (model_id,),
+        ):
+            return True
+        return False
+
+    @staticmethod
+    def _sql_value(value: Any) -> Tuple[str, Any]:
+        if isinstance(value, (list, dict)):
+            return 'json(?)', msgspec.json.encode(value).decode('utf-8')
+        return '?', value
+
+    def _execute_query(self, query: Query) -> Iterator[StoredModel]:
+        last_related = query.related_model[-1] if query.related_model else None
+        (prev_cls, prev_id) = self._related(last_related)
+        sql = self._sql(query.model_class)
+
+        conditions = ['related_id=? and related_name=?' if prev_cls else 'related_id is null']
+        params = [prev_id, prev_cls.__name__] if prev_cls else []
+        for condition in query.conditions:
+            column = self._json_field(condition.field)
+            if condition.op in ('in', 'not in'):
+                placeholders = []
+                for value in condition.value:
+                    placeholder, value = self._sql_value(value)
+                    placeholders.append(placeholder)
+                    params.append(value)
+                conditions.append(f"{column} {condition.op} ({', '.join(placeholders)})")
+            elif condition.value is None and condition.op in ('=', '!='):
+                conditions.append(f"{column} is {'not ' if condition.op == '!=' else ''}null")
+            else:
+                placeholder, value = self._sql_value(condition.value)
+                conditions.append(f'{column} {condition.op} {placeholder}')
+                params.append(value)
+
+        ordering = [f"{self._json_field(order.field)} {'desc' if order.descending else 'asc'}"
+                    for order in query.ordering] + ['id']
+        params.append(-1 if query.max_count is None else query.max_count)
+
+        rows = iter(self._read(
             f"""
-            select distinct id, data, related_id, related_name
-            from {table_name}
-            where {'related_id=? and related_name=?' if prev_cls else 'related_id is null'}   
+            select id, cast(data as blob) from {sql.table_name}
+            where {' and '.join(conditions)}
+            order by {', '.join(ordering)}
+            limit ?
             """,
-            (prev_id, prev_cls.__name__) if prev_cls else (),
-        )]
+            tuple(params),
+        ))
+        while batch := list(itertools.islice(rows, self.fetch_size)):
+            yield from decode_many(query.model_class, batch)
+
+    def _close_connections(self) -> None:
+        with self._lock:
+            for con in self._readers:
+                con.close()
+            self._readers.clear()
+            self._local = threading.local()
+            self.con.close()
+
+    def close(self) -> None:
+        """
+        Commit pending writes and close the storage.
+        """
+        self.commit()
+        self._close_connections()
 
     def destroy(self) -> None:
-        self.con.close()
-        if self.base_path.exists():
-            os.unlink(self.base_path)
+        self._close_connections()
+        self.invalidate_schema_cache()
+        for suffix in ('', '-wal', '-shm'):
+            path = self.base_path.with_name(self.base_path.name + suffix)
+            if path.exists():
+                os.unlink(path)
 
     def __str__(self) -> str:
         return f'sqlite.Storage(base_path={self.base_path})'
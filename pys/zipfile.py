@@ -1,50 +1,346 @@
 import os
+import threading
+import warnings
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Type, Any, Optional, Iterable, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Type, Any, Optional, Iterable, Union, List, Iterator, Dict
 
 import zipremove as zipfile
+from filelock import FileLock
 
 from pys import file
-from pys.base import StoredModel, Related
+from pys.base import BaseStorage, StoredModel, Related, RawModel, decode_cursor, decode_model, decode_many, \
+    model_json
 
 
 class Storage(file.Storage):
-    def __init__(self, base_path: Union[str, Path]) -> None:
+    """
+    ZIP-file based storage implementation. Every operation locks the archive, so it is thread and interprocess safe.
+    Use `session()` to keep the archive open and locked for many operations and write their changes at once.
+
+    The archive is append-only: a saved model is appended as a new entry and a deleted one as an empty entry
+    (tombstone), the newest entry of a name wins. Replaced entries and tombstones are garbage until `compact()`.
+    """
+    compressions = {
+        'stored': zipfile.ZIP_STORED,
+        'deflate': zipfile.ZIP_DEFLATED,
+        'bzip2': zipfile.ZIP_BZIP2,
+        'lzma': zipfile.ZIP_LZMA,
+    }
+
+    def __init__(self, base_path: Union[str, Path],
+                 compression: str = 'deflate',
+                 compresslevel: Optional[int] = 9,
+                 compact_threshold: Optional[float] = 0.5,
+                 read_workers: int = 0,
+                 mtime_resolution: float = 2.0) -> None:
         """
         Base path for the storage file
         :param base_path: base path.
+        :param compression: Compression of written models: `stored`, `deflate`, `bzip2` or `lzma`.
+            Models written with other compression are still read.
+        :param compresslevel: Compression level: 0-9 for `deflate`, 1-9 for `bzip2`,
+            None for the default level of the compression.
+        :param compact_threshold: Compact the archive after a write when garbage exceeds this share of its entries
+            size, None to compact only by `compact()`.
+        :param read_workers: Number of threads decompressing models for `list()` and `load_many()`, 0 to decompress
+            them in the calling thread.
+        :param mtime_resolution: Modification time resolution of the file system in seconds, the archive changed
+            more recently has no stamp and is reopened by every read.
+        """
+        super().__init__(base_path, read_workers=read_workers, mtime_resolution=mtime_resolution)
+        if compression not in self.compressions:
+            raise ValueError(f'Wrong compression: {compression}')
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.compact_threshold = compact_threshold
+        self._lock = threading.RLock()
+        self._archive_lock = FileLock(f'{self.base_path}.lock')
+        # Archive kept open by session and changes to be written at its end, None for deleted entries
+        self._root: Optional[zipfile.ZipFile] = None
+        self._pending: Dict[str, Optional[bytes]] = {}
+        self._sessions = 0
+
+    def _entry_name(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> str:
+        return self._get_model_path(model_class, model_id, *related_model).with_suffix('.json').as_posix()
+
+    @contextmanager
+    def session(self) -> Iterator['Storage']:
+        """
+        Keep the archive open and locked until exit. Reads use the central directory parsed once,
+        writes are buffered and appended at once on exit with one central directory write, or discarded
+        on exception. Other threads and processes wait for the end of session.
         """
-        super().__init__(base_path)
+        with self._lock:
+            if not self._sessions:
+                self._archive_lock.acquire()
+                try:
+                    self._root = zipfile.ZipFile(self.base_path, 'a')
+                except BaseException:
+                    self._archive_lock.release()
+                    raise
+            self._sessions += 1
+            try:
+                yield self
+                if self._sessions == 1:
+                    self._flush(reopen=False)
+            except BaseException:
+                if self._sessions == 1:
+                    self._pending.clear()
+                raise
+            finally:
+                self._sessions -= 1
+                if not self._sessions:
+                    try:
+                        self._root.close()
+                    finally:
+                        self._root = None
+                        self._archive_lock.release()
+
+    def flush(self) -> None:
+        """
+        Write changes buffered by the session to the archive.
+        """
+        with self._lock:
+            self._flush(reopen=True)
+
+    def _flush(self, reopen: bool) -> None:
+        if self._root is None or not self._pending:
+            return
+        with warnings.catch_warnings():
+            # Entries are replaced by appending new ones with the same name
+            warnings.filterwarnings('ignore', 'Duplicate name', UserWarning)
+            for name, content in self._pending.items():
+                if content is not None:
+                    self._root.writestr(name, content, compress_type=self.compressions[self.compression],
+                                        compresslevel=self.compresslevel)
+                elif self._live_info(self._root, name) is not None:
+                    self._root.writestr(name, b'', compress_type=zipfile.ZIP_STORED)
+        self._pending.clear()
+        if self.compact_threshold is not None:
+            garbage = self._garbage(self._root)
+            total_size = sum(self._entry_size(info) for info in self._root.filelist)
+            if sum(self._entry_size(info) for info in garbage) > total_size * self.compact_threshold:
+                self._compact(self._root, garbage)
+        if reopen:
+            # Closing writes the central directory once for all changes
+            self._root.close()
+            self._root = zipfile.ZipFile(self.base_path, 'a')
+
+    def compact(self) -> None:
+        """
+        Remove replaced and deleted entries from the archive and reclaim their space.
+        """
+        with self.session():
+            self._flush(reopen=False)
+            self._compact(self._root, self._garbage(self._root))
+
+    @staticmethod
+    def _compact(root: zipfile.ZipFile, garbage: List[zipfile.ZipInfo]) -> None:
+        if not garbage:
+            return
+        for info in garbage:
+            root.remove(info)
+        root.repack(garbage)
+
+    @staticmethod
+    def _garbage(root: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+        # The newest entry of a name is in NameToInfo, older ones and tombstones are garbage
+        live = {id(info) for info in root.NameToInfo.values() if info.file_size}
+        return [info for info in root.filelist if id(info) not in live]
+
+    @staticmethod
+    def _entry_size(info: zipfile.ZipInfo) -> int:
+        # Local file header and compressed content
+        return 30 + len(info.filename.encode('utf-8')) + len(info.extra) + info.compress_size
+
+    @staticmethod
+    def _live_info(root: Optional[zipfile.ZipFile], name: str) -> Optional[zipfile.ZipInfo]:
+        info = root.NameToInfo.get(name) if root is not None else None
+        return info if info is not None and info.file_size else None
+
+    @contextmanager
+    def _archive(self, reader: Optional['_Reader'] = None) -> Iterator[Optional[zipfile.ZipFile]]:
+        """
+        Get the archive kept open by session or open it for reading, None if the archive does not exist.
+        :param reader: Reader keeping the archive open between calls outside of session.
+        """
+        with self._lock:
+            if self._root is not None:
+                yield self._root
+                return
+        with self._archive_lock:
+            if reader is not None:
+                yield reader.open()
+                return
+            if not os.path.exists(self.base_path):
+                yield None
+                return
+            with zipfile.ZipFile(self.base_path, 'r') as root:
+                yield root
+
+    def _read_entry(self, root: Optional[zipfile.ZipFile], name: str) -> Optional[bytes]:
+        if name in self._pending:
+            return self._pending[name]
+        info = self._live_info(root, name)
+        return root.read(info) if info is not None else None
+
+    def _read_entries(self, root: Optional[zipfile.ZipFile], names: List[str]) -> List[Optional[bytes]]:
+        # Entries are read from one handle, zlib releases the GIL, so threads decompress them in parallel
+        if self.read_workers > 1 and len(names) > 1:
+            with self._scans_lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.read_workers, thread_name_prefix='pys-read')
+            return list(self._pool.map(lambda name: self._read_entry(root, name), names))
+        return [self._read_entry(root, name) for name in names]
+
+    def _write_entries(self, entries: Dict[str, Optional[bytes]]) -> None:
+        with self.session():
+            self._pending.update(entries)
 
     def load(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> Optional[StoredModel]:
-        with zipfile.ZipFile(self.base_path, 'r') as root:
-            path = self._get_model_path(
-                model_class, model_id, *related_model).with_suffix('.json').as_posix()
-            return model_class.__factory__(root.read(path), model_id)
+        with self._archive() as root:
+            raw_content = self._read_entry(root, self._entry_name(model_class, model_id, *related_model))
+        return decode_model(model_class, raw_content, model_id) if raw_content is not None else None
 
     def save(self, model: StoredModel, *related_model: Related) -> Any:
-        with zipfile.ZipFile(self.base_path, 'a', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as root:
-            path = self._get_model_path(
-                model.__class__, model.__my_id__(), *related_model).with_suffix('.json').as_posix()
-            root.writestr(str(path), model.__json__())
+        model_id = model.__my_id__()
+        self._write_entries({self._entry_name(model.__class__, model_id, *related_model): model_json(model)})
+        return model_id
 
     def delete(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> None:
-        with zipfile.ZipFile(self.base_path, 'a') as root:
-            path = self._get_model_path(model_class, model_id, *related_model).with_suffix('.json').as_posix()
-            try:
-                root.remove(path)
-            except KeyError:
-                pass
-
-    def list(self, model_class: Type[StoredModel], *related_model: Related) -> Iterable[StoredModel]:
-        with zipfile.ZipFile(self.base_path, 'r') as root:
-            path = zipfile.Path(
-                root,
-                f"{self._get_model_path(model_class, '__list__', *related_model).parent.as_posix()}/",
-            )
-            for mf in path.iterdir():
-                if mf.name.endswith(".json"):
-                    yield self.load(model_class, mf.name[:Storage._JSON_EXT_END], *related_model)
+        self._write_entries({self._entry_name(model_class, model_id, *related_model): None})
+
+    def save_many(self, models: Iterable[StoredModel], *related_model: Related) -> List[Any]:
+        ids = []
+        entries = {}
+        for model in models:
+            model_id = model.__my_id__()
+            entries[self._entry_name(model.__class__, model_id, *related_model)] = model_json(model)
+            ids.append(model_id)
+        self._write_entries(entries)
+        return ids
+
+    def load_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                  *related_model: Related) -> List[Optional[StoredModel]]:
+        model_ids = list(model_ids)
+        with self._archive() as root:
+            raw_contents = self._read_entries(
+                root, [self._entry_name(model_class, model_id, *related_model) for model_id in model_ids])
+        found = [(model_id, raw_content) for model_id, raw_content in zip(model_ids, raw_contents)
+                 if raw_content is not None]
+        models = iter(decode_many(model_class, found))
+        return [next(models) if raw_content is not None else None for raw_content in raw_contents]
+
+    def delete_many(self, model_class: Type[StoredModel], model_ids: Iterable[Any],
+                    *related_model: Related) -> None:
+        self._write_entries({self._entry_name(model_class, model_id, *related_model): None
+                             for model_id in model_ids})
+
+    def _members(self, root: Optional[zipfile.ZipFile],
+                 model_class: Type[StoredModel], *related_model: Related) -> Dict[str, str]:
+        """
+        Find models stored in the archive by one pass over its central directory and changes of the session.
+        :return: Entry names by model IDs.
+        """
+        prefix = f"{self._class_path(model_class, *related_model).as_posix()}/"
+        start = len(prefix)
+
+        def matches(name: str) -> bool:
+            return name.startswith(prefix) and name.endswith('.json') and name.find('/', start) < 0
+
+        members = {name[start:Storage._JSON_EXT_END]: name for name, info in root.NameToInfo.items()
+                   if info.file_size and matches(name)} if root is not None else {}
+        for name, content in self._pending.items():
+            if not matches(name):
+                continue
+            if content is None:
+                members.pop(name[start:Storage._JSON_EXT_END], None)
+            else:
+                members[name[start:Storage._JSON_EXT_END]] = name
+        return members
+
+    def list_ids(self, model_class: Type[StoredModel],
+                 *related_model: Related,
+                 limit: Optional[int] = None,
+                 after: Optional[str] = None) -> Iterator[Any]:
+        with self._archive() as root:
+            return iter(self._page(self._members(root, model_class, *related_model), limit, decode_cursor(after)))
+
+    def count(self, model_class: Type[StoredModel], *related_model: Related) -> int:
+        with self._archive() as root:
+            return len(self._members(root, model_class, *related_model))
+
+    def exists(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> bool:
+        name = self._entry_name(model_class, model_id, *related_model)
+        with self._archive() as root:
+            if name in self._pending:
+                return self._pending[name] is not None
+            return self._live_info(root, name) is not None
+
+    def stamp(self, model_class: Type[StoredModel], model_id: Any, *related_model: Related) -> Optional[file.Stamp]:
+        # Every write changes the archive
+        return self._stamp(self.base_path)
+
+    def list_stamp(self, model_class: Type[StoredModel], *related_model: Related) -> Optional[file.Stamp]:
+        return self._stamp(self.base_path)
+
+    def reshard(self, shard_levels: int, shard_width: int = 2) -> None:
+        raise NotImplementedError('ZIP storage keeps models in one archive and has no shards')
+
+    # Index markers are not kept in the archive, models are scanned
+    find_by = BaseStorage.find_by
+
+    def _iter_raw(self, model_class: Type[StoredModel],
+                  *related_model: Related,
+                  limit: Optional[int] = None,
+                  after: Optional[str] = None) -> Iterator[RawModel]:
+        # The archive is not locked while models are consumed, but it is kept open for the next batches
+        reader = _Reader(self)
+        try:
+            with self._archive(reader) as root:
+                members = self._members(root, model_class, *related_model)
+            model_ids = self._page(members, limit, after)
+            for start in range(0, len(model_ids), self.decode_batch_size):
+                batch = model_ids[start:start + self.decode_batch_size]
+                with self._archive(reader) as root:
+                    raw_contents = self._read_entries(root, [members[model_id] for model_id in batch])
+                for model_id, raw_content in zip(batch, raw_contents):
+                    if raw_content is not None:
+                        yield model_id, raw_content
+        finally:
+            reader.close()
+
+    def __str__(self) -> str:
+        return f'zipfile.Storage(base_path={self.base_path}, compression={self.compression}, ' \
+               f'compresslevel={self.compresslevel})'
 
     def destroy(self) -> None:
+        self.close()
         os.unlink(self.base_path)
+        Path(self._archive_lock.lock_file).unlink(missing_ok=True)
+
+
+class _Reader:
+    """
+    Archive kept open between batches of a listing, it is reopened if the archive was changed meanwhile.
+    """
+    def __init__(self, storage: Storage) -> None:
+        self.storage = storage
+        self.root: Optional[zipfile.ZipFile] = None
+        self.stamp: Optional[file.Stamp] = None
+
+    def open(self) -> Optional[zipfile.ZipFile]:
+        stamp = self.storage._stamp(self.storage.base_path)
+        if self.root is None or stamp is None or stamp != self.stamp:
+            self.close()
+            if os.path.exists(self.storage.base_path):
+                self.root = zipfile.ZipFile(self.storage.base_path, 'r')
+                self.stamp = stamp
+        return self.root
+
+    def close(self) -> None:
+        if self.root is not None:
+            self.root.close()
+            self.root = None
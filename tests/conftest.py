@@ -0,0 +1,53 @@
+import msgspec
+import pytest
+
+import pys
+
+
+@pys.saveable
+class Author(msgspec.Struct):
+    id: str
+    name: str
+
+
+@pys.saveable
+class Book(msgspec.Struct):
+    id: str
+    title: str
+
+
+@pys.saveable
+class Note(msgspec.Struct):
+    id: str
+    text: str
+
+
+# Storage factories by backend, they take a name for storage files, e.g. the name of the test module
+backends = {
+    'file': lambda name: pys.file_storage(f'{name}.storage'),
+    'sqlite': lambda name: pys.sqlite_storage(f'{name}.db'),
+    'zip': lambda name: pys.zip_storage(f'{name}.zip'),
+    'log': lambda name: pys.log_storage(f'{name}.log'),
+    'dbm': lambda name: pys.dbm_storage(f'{name}.dbm'),
+}
+
+
+def pytest_generate_tests(metafunc):
+    """
+    Run tests using `backend` (or `storage`) fixture with every backend. A test module may declare
+    `exclude_backends` names and `extra_backends` factories by name, the latter replace default ones.
+    """
+    if 'backend' not in metafunc.fixturenames:
+        return
+    module_backends = {name: factory for name, factory in backends.items()
+                       if name not in getattr(metafunc.module, 'exclude_backends', ())}
+    module_backends.update(getattr(metafunc.module, 'extra_backends', {}))
+    metafunc.parametrize('backend', list(module_backends.values()), ids=list(module_backends))
+
+
+@pytest.fixture
+def storage(request, backend):
+    # Storage files are named after the test module
+    s = backend(request.module.__name__.rpartition('.')[2].removeprefix('test_'))
+    yield s
+    s.destroy()
@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import pys
+
+from .conftest import Note
+
+
+exclude_backends = ('zip', 'dbm')
+extra_backends = {
+    'sqlite': lambda name: pys.sqlite_storage(f'{name}.db', thread_safe=True),
+}
+
+
+def test_operations(storage):
+    async def run():
+        async with pys.async_storage(storage, max_workers=4) as s:
+            await s.save(Note(id='1', text='first'))
+            await s.save_many([Note(id=str(i), text=str(i)) for i in range(2, 6)])
+            assert (await s.load(Note, '1')).text == 'first'
+            assert await s.load(Note, '9') is None
+            assert await s.load_many(Note, ['2', '9']) == [Note(id='2', text='2'), None]
+            await s.delete(Note, '5')
+            await s.delete_many(Note, ['4'])
+            assert [n.id async for n in s.list(Note)] == ['1', '2', '3']
+            assert [n.id async for n in s.list(Note, limit=2, after=s.cursor(Note(id='1', text='')))] == ['2', '3']
+            assert await s.list_ids(Note) == ['1', '2', '3']
+            assert await s.count(Note) == 3
+            assert await s.exists(Note, '3')
+
+    asyncio.run(run())
+
+
+def test_list_pages(storage):
+    storage.decode_batch_size = 3
+    storage.save_many([Note(id=f'{i:02}', text=str(i)) for i in range(10)])
+
+    async def run():
+        async with pys.async_storage(storage, max_workers=4) as s:
+            assert [n.id async for n in s.list(Note)] == [f'{i:02}' for i in range(10)]
+            assert [n.id async for n in s.list(Note, limit=7)] == [f'{i:02}' for i in range(7)]
+            assert [n.id async for n in s.list(Note, limit=6, after=s.cursor(Note(id='05', text='')))] == \
+                ['06', '07', '08', '09']
+
+    asyncio.run(run())
+
+
+class SlowStorage(pys.CachedStorage):
+    def __init__(self, inner):
+        super().__init__(inner, max_items=0)
+        self.loads = 0
+        self.writers = set()
+
+    def load(self, model_class, model_id, *related_model):
+        self.loads += 1
+        time.sleep(0.05)
+        return self.inner.load(model_class, model_id, *related_model)
+
+    def save(self, model, *related_model):
+        self.writers.add(threading.current_thread().name)
+        return self.inner.save(model, *related_model)
+
+
+def test_coalesce_loads():
+    inner = SlowStorage(pys.file_storage('aio.storage'))
+
+    async def run():
+        async with pys.async_storage(inner) as s:
+            await s.save(Note(id='1', text='first'))
+            notes = await asyncio.gather(*[s.load(Note, '1') for _ in range(10)])
+            assert all(note is notes[0] for note in notes)
+            assert inner.loads == 1
+
+            # A load started before a write is not joined after it
+            loading = asyncio.ensure_future(s.load(Note, '1'))
+            await asyncio.sleep(0)
+            await s.save(Note(id='1', text='changed'))
+            assert (await s.load(Note, '1')).text == 'changed'
+            await loading
+            assert inner.loads == 3
+
+    try:
+        asyncio.run(run())
+    finally:
+        inner.destroy()
+
+
+def test_sqlite_writer():
+    inner = pys.sqlite_storage('aio.db', thread_safe=True)
+    slow = SlowStorage(inner)
+
+    async def run():
+        async with pys.async_storage(slow) as s:
+            await asyncio.gather(*[s.save(Note(id=str(i), text=str(i))) for i in range(20)])
+            assert await s.count(Note) == 20
+
+    try:
+        asyncio.run(run())
+        assert len(slow.writers) == 1
+    finally:
+        inner.destroy()
+
+    inner = pys.sqlite_storage('aio.db')
+    try:
+        with pytest.raises(ValueError):
+            pys.async_storage(inner)
+    finally:
+        inner.destroy()
@@ -0,0 +1,45 @@
+import threading
+
+import pys
+
+from .conftest import Note
+
+
+exclude_backends = ('sqlite', 'zip', 'log', 'dbm')
+extra_backends = {
+    'file': lambda name: pys.file_storage(f'{name}.storage', atomic_writes=True),
+    'fsync': lambda name: pys.file_storage(f'{name}-fsync.storage', atomic_writes=True, fsync=True, shard_levels=1),
+}
+
+
+def test_no_locks(storage):
+    storage.save(Note(id='1', text='first'))
+    storage.save_many([Note(id='2', text='second'), Note(id='3', text='third')])
+    assert storage.load(Note, '1').text == 'first'
+    assert storage.load(Note, '4') is None
+    assert [n.id for n in storage.list(Note)] == ['1', '2', '3']
+    storage.delete(Note, '3')
+
+    files = [path.name for path in storage.base_path.rglob('*') if path.is_file()]
+    assert sorted(files) == ['1.json', '2.json']
+
+
+def test_readers_see_whole_models(storage):
+    texts = [str(i) * 100_000 for i in range(10)]
+    storage.save(Note(id='1', text=texts[0]))
+    stop = threading.Event()
+
+    def write():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            storage.save(Note(id='1', text=texts[i % len(texts)]))
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for _ in range(200):
+            assert storage.load(Note, '1').text in texts
+    finally:
+        stop.set()
+        writer.join()
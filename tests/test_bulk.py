@@ -0,0 +1,35 @@
+import pys
+
+from .conftest import Author, Book
+
+
+extra_backends = {
+    'threads': lambda name: pys.file_storage(f'{name}-threads.storage', read_workers=4),
+}
+
+
+def test_save_load_many(storage):
+    authors = [Author(id=str(i), name=f'Author {i}') for i in range(10)]
+    assert storage.save_many(authors) == [a.id for a in authors]
+
+    loaded = storage.load_many(Author, [a.id for a in authors])
+    assert loaded == authors
+    assert storage.load(Author, '5') == authors[5]
+
+
+def test_related_many(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    storage.save(leo)
+    books = [Book(id=str(i), title=f'Book {i}') for i in range(5)]
+    storage.save_many(books, leo)
+
+    assert storage.load_many(Book, ['1', 'missing', '3'], leo) == [books[1], None, books[3]]
+    assert sorted(b.id for b in storage.list(Book, leo)) == [b.id for b in books]
+
+
+def test_delete_many(storage):
+    authors = [Author(id=str(i), name=f'Author {i}') for i in range(5)]
+    storage.save_many(authors)
+
+    storage.delete_many(Author, ['1', '2'])
+    assert storage.load_many(Author, ['0', '1', '2', '3']) == [authors[0], None, None, authors[3]]
@@ -0,0 +1,93 @@
+import pytest
+
+import pys
+
+from .conftest import Author, Book
+
+
+@pytest.fixture
+def storage(backend):
+    s = pys.cached_storage(backend('cache'), max_items=3, cache_lists=True)
+    yield s
+    s.destroy()
+
+
+def test_load(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    storage.save(leo)
+
+    assert storage.load(Author, 'leo') == leo
+    assert storage.load(Author, 'leo') is storage.load(Author, 'leo')
+    assert storage.stats.hits == 2
+    assert storage.stats.misses == 1
+
+    leo.name = 'Lev Tolstoy'
+    storage.save(leo)
+    assert storage.load(Author, 'leo').name == 'Lev Tolstoy'
+    assert storage.stats.misses == 2
+
+    storage.delete(Author, 'leo')
+    assert storage.load(Author, 'leo') is None
+
+
+def test_lru(storage):
+    authors = [Author(id=str(i), name=f'Author {i}') for i in range(5)]
+    storage.save_many(authors)
+    assert storage.load_many(Author, [a.id for a in authors]) == authors
+    assert storage.stats.items == 3
+    assert storage.stats.evictions == 2
+
+    storage.load(Author, '4')
+    storage.load(Author, '0')
+    assert storage.stats.hits == 1
+    assert storage.stats.misses == 6
+
+
+def test_relations(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    storage.save(leo)
+    war_and_peace = Book(id='1', title='War and Peace')
+    storage.save(war_and_peace, leo)
+
+    assert storage.load(Book, '1', leo) == war_and_peace
+    assert storage.load(Book, '1', (Author, 'leo')) is storage.load(Book, '1', leo)
+    assert storage.load(Book, '1') is None
+
+    assert list(storage.list(Book, leo)) == [war_and_peace]
+    anna_karenina = Book(id='2', title='Anna Karenina')
+    storage.save(anna_karenina, leo)
+    assert list(storage.list(Book, leo)) == [war_and_peace, anna_karenina]
+
+    storage.delete(Author, 'leo')
+    assert storage.stats.items == 0
+
+
+def test_bytes_limit():
+    s = pys.cached_storage(pys.sqlite_storage('cache-bytes.db'), max_items=None, max_bytes=100)
+    try:
+        s.save_many([Author(id=str(i), name=f'Author {i}') for i in range(10)])
+        list(s.load_many(Author, [str(i) for i in range(10)]))
+        assert 0 < s.stats.size <= 100
+        assert s.stats.items < 10
+    finally:
+        s.destroy()
+
+
+def test_transaction_rollback():
+    s = pys.cached_storage(pys.sqlite_storage('cache-transaction.db'))
+    try:
+        s.save(Author(id='leo', name='Leo Tolstoy'))
+        assert s.load(Author, 'leo').name == 'Leo Tolstoy'
+        with pytest.raises(RuntimeError):
+            with s.transaction():
+                s.save(Author(id='leo', name='Lev Tolstoy'))
+                assert s.load(Author, 'leo').name == 'Lev Tolstoy'
+                raise RuntimeError
+        assert s.load(Author, 'leo').name == 'Leo Tolstoy'
+
+        with s.transaction():
+            s.save(Author(id='leo', name='Lev Tolstoy'))
+            s.load(Author, 'leo')
+        assert s.load(Author, 'leo').name == 'Lev Tolstoy'
+    finally:
+        s.destroy()
@@ -0,0 +1,41 @@
+from .conftest import Author, Book
+
+
+def test_count(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    fyodor = Author(id='fyodor', name='Fyodor Dostoyevsky')
+    storage.save_many([leo, fyodor])
+    storage.save_many([Book(id=str(i), title=f'Book {i}') for i in range(5)], leo)
+    storage.save(Book(id='0', title='Crime and Punishment'), fyodor)
+
+    assert storage.count(Author) == 2
+    assert storage.count(Book, leo) == 5
+    assert storage.count(Book, fyodor) == 1
+    assert storage.count(Book) == 0
+
+    storage.delete(Book, '3', leo)
+    assert storage.count(Book, leo) == 4
+
+
+def test_exists(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    storage.save(leo)
+    storage.save(Book(id='1', title='War and Peace'), leo)
+
+    assert storage.exists(Author, 'leo')
+    assert not storage.exists(Author, 'fyodor')
+    assert storage.exists(Book, '1', leo)
+    assert not storage.exists(Book, '1')
+
+    storage.delete(Author, 'leo')
+    assert not storage.exists(Author, 'leo')
+
+
+def test_list_ids(storage):
+    storage.save_many([Author(id=f'{i:02}', name=f'Author {i}') for i in reversed(range(10))])
+
+    assert list(storage.list_ids(Author)) == [f'{i:02}' for i in range(10)]
+    assert list(storage.list_ids(Author, limit=3)) == ['00', '01', '02']
+    after = storage.cursor(Author(id='06', name='Author 6'))
+    assert list(storage.list_ids(Author, after=after)) == ['07', '08', '09']
+    assert list(storage.list_ids(Book)) == []
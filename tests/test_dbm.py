@@ -0,0 +1,40 @@
+import pytest
+
+import pys
+
+from .conftest import Author, Book
+
+
+@pytest.fixture
+def storage():
+    s = pys.dbm_storage('storage.dbm', backend='dumb')
+    yield s
+    s.destroy()
+
+
+def test_reopen(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    storage.save(leo)
+    storage.save_many([Book(id='1', title='War and Peace'), Book(id='2', title='Anna Karenina')], leo)
+    storage.save(Book(id='3', title='Crime and Punishment'), (Author, 'fyodor'))
+    storage.close()
+
+    # Keys are registered again from the database
+    storage = pys.dbm_storage('storage.dbm')
+    assert [b.title for b in storage.list(Book, leo)] == ['War and Peace', 'Anna Karenina']
+    assert storage.count(Book, (Author, 'fyodor')) == 1
+    assert storage.count(Book) == 0
+    assert [a.id for a in storage.list(Author)] == ['leo']
+    storage.close()
+
+
+def test_delete_related(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    storage.save(leo)
+    storage.save(Book(id='1', title='War and Peace'), leo)
+    storage.save(Book(id='2', title='Anna Karenina'), (Author, 'fyodor'))
+    storage.delete(Author, 'leo')
+    storage.delete(Author, 'fyodor')
+    assert storage.load(Author, 'leo') is None
+    assert storage.count(Book, leo) == 0
+    assert storage.load(Book, '2', (Author, 'fyodor')) is None
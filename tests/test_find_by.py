@@ -0,0 +1,103 @@
+import threading
+
+import msgspec
+from filelock import FileLock
+from pydantic import BaseModel
+
+import pys
+
+from .conftest import Author
+
+
+@pys.saveable(indexes=['email', ('status', 'year')])
+class Book(msgspec.Struct):
+    id: str
+    email: str
+    status: str
+    year: int
+
+
+@pys.saveable(indexes=['email'])
+class User(BaseModel):
+    email: str
+    name: str
+
+
+class Address(BaseModel):
+    city: str
+    street: str
+
+
+@pys.saveable(indexes=['address'])
+class Publisher(BaseModel):
+    id: str
+    address: Address
+
+
+extra_backends = {
+    'sharded': lambda name: pys.file_storage(f'{name}-sharded.storage', shard_levels=2),
+    'atomic': lambda name: pys.file_storage(f'{name}-atomic.storage', atomic_writes=True),
+}
+
+
+def test_find_by(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    storage.save(leo)
+    storage.save_many([
+        Book(id='1', email='a@example.com', status='draft', year=1865),
+        Book(id='2', email='b@example.com', status='published', year=1869),
+        Book(id='3', email='a@example.com', status='published', year=1869),
+    ], leo)
+
+    assert [b.id for b in storage.find_by(Book, leo, email='a@example.com')] == ['1', '3']
+    assert [b.id for b in storage.find_by(Book, leo, status='published', year=1869)] == ['2', '3']
+    assert [b.id for b in storage.find_by(Book, leo, email='a@example.com', year=1869)] == ['3']
+    assert list(storage.find_by(Book, email='a@example.com')) == []
+
+
+def test_find_by_updated(storage):
+    storage.save(Book(id='1', email='a@example.com', status='draft', year=1865))
+    storage.save(Book(id='1', email='b@example.com', status='draft', year=1865))
+    assert list(storage.find_by(Book, email='a@example.com')) == []
+    assert [b.id for b in storage.find_by(Book, email='b@example.com')] == ['1']
+
+    storage.delete(Book, '1')
+    assert list(storage.find_by(Book, email='b@example.com')) == []
+
+
+def test_find_by_without_id(storage):
+    user = User(email='leo@example.com', name='Leo')
+    storage.save(user)
+    assert list(storage.find_by(User, email='leo@example.com')) == [user]
+    assert list(storage.find_by(User, name='Leo')) == [user]
+
+
+def test_find_by_nested_model(storage):
+    moscow = Address(city='Moscow', street='Tverskaya')
+    storage.save_many([
+        Publisher(id='1', address=moscow),
+        Publisher(id='2', address=Address(city='Paris', street='Rivoli')),
+        Publisher(id='3', address=moscow),
+    ])
+    assert [p.id for p in storage.find_by(Publisher, address=moscow)] == ['1', '3']
+    assert [p.id for p in storage.query(Publisher).where('address', '!=', moscow)] == ['2']
+
+    storage.save(Publisher(id='1', address=Address(city='Paris', street='Rivoli')))
+    assert [p.id for p in storage.find_by(Publisher, address=moscow)] == ['3']
+
+
+def test_batch_writes_lock_models():
+    storage = pys.file_storage('find_by-locks.storage')
+    try:
+        storage.save(Book(id='1', email='a@example.com', status='draft', year=1865))
+        # Index markers of a model are updated under its file lock, as save() and delete() do
+        with FileLock(storage.base_path / 'Book' / '1.lock'):
+            writer = threading.Thread(target=storage.save_many,
+                                      args=([Book(id='1', email='b@example.com', status='draft', year=1865)],))
+            writer.start()
+            writer.join(0.1)
+            assert writer.is_alive()
+        writer.join()
+        assert [b.id for b in storage.find_by(Book, email='b@example.com')] == ['1']
+    finally:
+        storage.destroy()
@@ -0,0 +1,113 @@
+import os
+import threading
+
+import pytest
+from filelock import Timeout
+
+import pys
+
+from .conftest import Author, Book
+
+
+@pytest.fixture
+def storage():
+    s = pys.log_storage('log.storage', max_segment_size=1024, merge_threshold=None)
+    yield s
+    s.destroy()
+
+
+def segments(storage):
+    return sorted(name for name in os.listdir(storage.base_path) if name.endswith('.log'))
+
+
+def test_reopen(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    storage.save(leo)
+    storage.save_many([Book(id=str(i), title=f'Book {i}') for i in range(50)], leo)
+    storage.save(Author(id='leo', name='Lev Tolstoy'))
+    storage.delete_many(Book, ['1', '2'], leo)
+    assert len(segments(storage)) > 1
+    storage.close()
+
+    # The key directory is rebuilt from hint files
+    storage = pys.log_storage('log.storage', max_segment_size=1024, merge_threshold=None)
+    assert storage.load(Author, 'leo').name == 'Lev Tolstoy'
+    assert storage.count(Book, leo) == 48
+    assert storage.load(Book, '1', leo) is None
+    assert storage.load(Book, '3', leo).title == 'Book 3'
+    storage.close()
+
+
+def test_torn_record(storage):
+    storage.save(Author(id='leo', name='Leo Tolstoy'))
+    storage.save(Author(id='fyodor', name='Fyodor Dostoevsky'))
+    active = storage.base_path / segments(storage)[-1]
+    # Interrupted process leaves no hints and a part of the last record
+    storage._writer.close()
+    storage._process_lock.release()
+    with open(active, 'r+b') as f:
+        f.truncate(os.path.getsize(active) - 3)
+
+    storage = pys.log_storage('log.storage')
+    assert storage.load(Author, 'leo').name == 'Leo Tolstoy'
+    assert storage.load(Author, 'fyodor') is None
+    storage.save(Author(id='fyodor', name='Fyodor Dostoevsky'))
+    assert [a.id for a in storage.list(Author)] == ['fyodor', 'leo']
+    storage.close()
+
+
+def test_merge(storage):
+    for i in range(5):
+        storage.save_many([Book(id=str(j), title=f'Book {j}-{i}') for j in range(20)])
+    storage.delete_many(Book, [str(j) for j in range(10)])
+    size = sum(os.path.getsize(storage.base_path / name) for name in segments(storage))
+    storage.merge()
+    assert len(segments(storage)) == 2
+    assert sum(os.path.getsize(storage.base_path / name) for name in segments(storage)) < size / 5
+    assert [b.title for b in storage.list(Book)] == [f'Book {j}-4' for j in range(10, 20)]
+    storage.merge()
+    storage.close()
+
+    storage = pys.log_storage('log.storage')
+    assert [b.title for b in storage.list(Book)] == [f'Book {j}-4' for j in range(10, 20)]
+    storage.close()
+
+
+def test_background_merge():
+    storage = pys.log_storage('log-merge.storage', max_segment_size=1024, merge_threshold=0.5)
+    try:
+        for i in range(50):
+            storage.save(Book(id='1', title=f'Book {i}'))
+        storage.close()
+        # Replaced values were merged, the merged segment and the active one are left
+        assert len(segments(storage)) <= 3
+        storage = pys.log_storage('log-merge.storage')
+        assert storage.load(Book, '1').title == 'Book 49'
+    finally:
+        storage.destroy()
+
+
+def test_delete_related(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    storage.save(leo)
+    storage.save(Book(id='1', title='War and Peace'), leo)
+    storage.save(Book(id='2', title='Anna Karenina'), (Author, 'fyodor'))
+    storage.delete(Author, 'leo')
+    storage.delete(Author, 'fyodor')
+    assert storage.count(Book, leo) == 0
+    assert storage.count(Book, (Author, 'fyodor')) == 0
+
+
+def test_one_process(storage):
+    errors = []
+
+    def open_storage():
+        try:
+            pys.log_storage('log.storage')
+        except Timeout as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=open_storage)
+    thread.start()
+    thread.join()
+    assert len(errors) == 1
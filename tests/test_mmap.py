@@ -0,0 +1,86 @@
+import mmap
+from dataclasses import dataclass
+from typing import Any, List
+
+import msgspec
+import pytest
+from pydantic import BaseModel
+
+import pys
+import pys.file
+
+
+@pys.saveable
+class Document(msgspec.Struct):
+    id: str
+    lines: List[str]
+
+
+@pys.saveable
+class PydanticDocument(BaseModel):
+    id: str
+    lines: List[str]
+
+
+@pys.saveable
+@dataclass
+class DataclassDocument:
+    id: str
+    lines: List[str]
+
+
+@pys.saveable
+class CustomDocument(pys.Persistent):
+    def __init__(self, text):
+        self.id = 'custom'
+        self.text = text
+
+    @classmethod
+    def __factory__(cls, raw_content: str, model_id: Any) -> 'CustomDocument':
+        assert isinstance(raw_content, str)
+        return CustomDocument(raw_content)
+
+    def __json__(self) -> str:
+        return self.text
+
+    def __eq__(self, o: object) -> bool:
+        return self.text == o.text
+
+
+exclude_backends = ('sqlite', 'zip', 'log', 'dbm')
+extra_backends = {
+    'file': lambda name: pys.file_storage(f'{name}.storage', mmap_threshold=1024),
+    'atomic': lambda name: pys.file_storage(f'{name}-atomic.storage', mmap_threshold=1024, atomic_writes=True),
+}
+
+
+@pytest.fixture
+def storage(backend, monkeypatch):
+    s = backend('mmap')
+    mapped = []
+    original = mmap.mmap
+    monkeypatch.setattr(pys.file.mmap, 'mmap', lambda *args, **kwargs: mapped.append(args) or original(*args, **kwargs))
+    s.mapped = mapped
+    yield s
+    s.destroy()
+
+
+@pytest.mark.parametrize('cls', [Document, PydanticDocument, DataclassDocument])
+def test_large(storage, cls):
+    document = cls(id='large', lines=[f'Line {i}' for i in range(1000)])
+    storage.save(document)
+    small = cls(id='small', lines=['Line'])
+    storage.save(small)
+
+    assert storage.load(cls, 'large') == document
+    assert len(storage.mapped) == 1
+    assert storage.load(cls, 'small') == small
+    assert len(storage.mapped) == 1
+    assert storage.load(cls, 'missing') is None
+
+
+def test_custom(storage):
+    document = CustomDocument('x' * 2048)
+    storage.save(document)
+    assert storage.load(CustomDocument, 'custom') == document
+    assert len(storage.mapped) == 1
@@ -0,0 +1,33 @@
+import pys
+from pys.base import encode_cursor
+
+from .conftest import Author, Book
+
+
+extra_backends = {
+    'sharded': lambda name: pys.file_storage(f'{name}-sharded.storage', shard_levels=1),
+    'threads': lambda name: pys.file_storage(f'{name}-threads.storage', atomic_writes=True, read_workers=4),
+    'log': lambda name: pys.log_storage(f'{name}.log', max_segment_size=4096),
+}
+
+
+def test_pages(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    storage.save(leo)
+    books = [Book(id=f'{i:02}', title=f'Book {i}') for i in range(10)]
+    storage.save_many(reversed(books), leo)
+
+    listed = []
+    after = None
+    while page := list(storage.list(Book, leo, limit=3, after=after)):
+        assert len(page) <= 3
+        listed += page
+        after = storage.cursor(page[-1])
+    assert listed == books
+
+
+def test_lazy(storage):
+    storage.save_many([Author(id=str(i), name=f'Author {i}') for i in range(5)])
+    models = storage.list(Author)
+    assert next(models).id == '0'
+    assert [a.id for a in storage.list(Author, after=encode_cursor('2'))] == ['3', '4']
@@ -0,0 +1,39 @@
+from typing import List
+
+from pydantic import BaseModel
+
+import pys
+
+from .conftest import Note
+
+
+@pys.saveable
+class Book(BaseModel):
+    title: str
+    tags: List[str]
+
+
+exclude_backends = ('zip', 'dbm')
+extra_backends = {
+    'mmap': lambda name: pys.file_storage(f'{name}-mmap.storage', atomic_writes=True, mmap_threshold=0),
+}
+
+
+def test_list(storage):
+    notes = [Note(id=f'{i:04}', text=str(i)) for i in range(500)]
+    storage.save_many(notes)
+    with pys.ParallelLoader(storage, workers=2, chunk_size=64, threshold=100) as loader:
+        assert list(loader.list(Note)) == notes
+        assert list(loader.list(Note, limit=150, after=storage.cursor(notes[99]))) == notes[100:250]
+        # Below the threshold models are decoded without worker processes
+        assert list(loader.list(Note, limit=10)) == notes[:10]
+
+
+def test_pydantic(storage):
+    author = Note(id='leo', text='Leo Tolstoy')
+    books = [Book(title=f'Book {i}', tags=['novel', str(i)]) for i in range(300)]
+    storage.save_many(books, author)
+    with pys.ParallelLoader(storage, workers=2, chunk_size=32, threshold=0) as loader:
+        loaded = list(loader.list(Book, author))
+    assert sorted(b.title for b in loaded) == sorted(b.title for b in books)
+    assert [b.__my_id__() for b in loaded] == sorted(b.__my_id__() for b in books)
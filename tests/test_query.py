@@ -0,0 +1,80 @@
+from typing import Any, Optional
+
+import msgspec
+import pytest
+
+import pys
+
+from .conftest import Author
+
+
+@pys.saveable
+class Book(msgspec.Struct):
+    id: str
+    title: str
+    year: int
+    status: Optional[str] = None
+
+
+@pys.saveable
+class Setting(msgspec.Struct):
+    id: str
+    value: Any = None
+
+
+extra_backends = {
+    'atomic': lambda name: pys.file_storage(f'{name}-atomic.storage', atomic_writes=True, shard_levels=1),
+}
+
+
+@pytest.fixture
+def storage(backend):
+    s = backend('query')
+    leo = Author(id='leo', name='Leo Tolstoy')
+    s.save(leo)
+    s.save_many([
+        Book(id='1', title='Childhood', year=1852, status='published'),
+        Book(id='2', title='War and Peace', year=1869, status='published'),
+        Book(id='3', title='Anna Karenina', year=1878),
+        Book(id='4', title='Resurrection', year=1899, status='draft'),
+    ], leo)
+    yield s
+    s.destroy()
+
+
+def _ids(query) -> list:
+    return [book.id for book in query]
+
+
+def test_where(storage):
+    leo = (Author, 'leo')
+    assert _ids(storage.query(Book, leo).where('year', '>', 1860)) == ['2', '3', '4']
+    assert _ids(storage.query(Book, leo).where('year', '>', 1860).where(status='published')) == ['2']
+    assert _ids(storage.query(Book, leo).where('status', 'in', ['draft', 'published'])) == ['1', '2', '4']
+    assert _ids(storage.query(Book, leo).where(status=None)) == ['3']
+    assert _ids(storage.query(Book, leo).where('status', '!=', 'draft')) == ['1', '2']
+    assert _ids(storage.query(Book).where('year', '>', 1860)) == []
+
+
+def test_order_limit(storage):
+    leo = (Author, 'leo')
+    assert _ids(storage.query(Book, leo).order_by('-year').limit(2)) == ['4', '3']
+    assert _ids(storage.query(Book, leo).order_by('status', '-year')) == ['3', '4', '2', '1']
+    assert _ids(storage.query(Book, leo).where('year', '<', 1890).limit(2)) == ['1', '2']
+
+
+def test_wrong_query(storage):
+    with pytest.raises(ValueError):
+        storage.query(Book).where('year', 'like', 1860)
+    with pytest.raises(ValueError):
+        storage.query(Book).where("year') or 1=1 --", '=', 1860)
+
+
+def test_order_mixed_types(storage):
+    storage.save_many([
+        Setting(id='1', value='b'), Setting(id='2', value=2), Setting(id='3'), Setting(id='4', value=[1]),
+        Setting(id='5', value=1.5), Setting(id='6', value='a'),
+    ])
+    # Missing values, numbers, then strings and JSON arrays by their text, the same way for all storages
+    assert _ids(storage.query(Setting).order_by('value')) == ['3', '5', '2', '4', '6', '1']
+    assert _ids(storage.query(Setting).order_by('-value')) == ['1', '6', '4', '2', '5', '3']
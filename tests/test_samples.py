@@ -205,3 +205,42 @@ def test_sample(storage, cls_author, cls_book):
     assert len(leo_books) == 2
     assert war_and_peace in leo_books
     assert for_kids in leo_books
+
+
+@pytest.mark.parametrize(
+    argnames=('cls_author', 'cls_book'),
+    argvalues=dataclass_cases() + msgspec_structs() + pydantic_models() + models_with_id() + custom_cases()
+)
+def test_loaded_id(storage, cls_author, cls_book):
+    leo = cls_author(name='Leo Tolstoy')
+    storage.save(leo)
+
+    leo2 = storage.load(cls_author, leo.__my_id__())
+    assert leo2.__my_id__() == leo.__my_id__()
+
+
+@pytest.mark.parametrize(
+    argnames=('cls_author', 'cls_book'),
+    argvalues=dataclass_cases() + msgspec_structs() + pydantic_models() + models_with_id() + custom_cases()
+)
+def test_factory_many(cls_author, cls_book):
+    books = [cls_book(title='War and peace'), cls_book(title='For Kids')]
+    ids = [book.__my_id__() for book in books]
+
+    loaded = cls_book.__factory_many__([book.__json__() for book in books], ids)
+    assert loaded == books
+    assert [book.__my_id__() for book in loaded] == ids
+
+
+@pytest.mark.parametrize(
+    argnames=('cls_author', 'cls_book'),
+    argvalues=dataclass_cases() + msgspec_structs() + pydantic_models() + models_with_id()
+)
+def test_json_bytes(cls_author, cls_book):
+    book = cls_book(title='War and peace')
+    book_id = book.__my_id__()
+
+    raw_content = book.__json_bytes__()
+    assert raw_content == book.__json__().encode('utf-8')
+    assert cls_book.__factory__(raw_content, book_id) == book
+    assert cls_book.__factory_many__([raw_content], [book_id]) == [book]
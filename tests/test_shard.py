@@ -0,0 +1,75 @@
+import hashlib
+
+import msgspec
+import pytest
+
+import pys
+
+from .conftest import Author
+
+
+@pys.saveable(indexes=['year'])
+class Book(msgspec.Struct):
+    id: str
+    title: str
+    year: int
+
+
+@pytest.fixture
+def storage():
+    s = pys.file_storage('shard.storage', shard_levels=2)
+    yield s
+    s.destroy()
+
+
+def test_layout(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    storage.save(leo)
+    storage.save(Book(id='1', title='War and Peace', year=1869), leo)
+
+    leo_hash = hashlib.sha1(b'leo').hexdigest()
+    book_hash = hashlib.sha1(b'1').hexdigest()
+    assert (storage.base_path / 'Author' / leo_hash[:2] / leo_hash[2:4] / 'leo.json').exists()
+    assert (storage.base_path / 'Author' / leo_hash[:2] / leo_hash[2:4] / 'leo' /
+            'Book' / book_hash[:2] / book_hash[2:4] / '1.json').exists()
+
+
+def test_operations(storage):
+    leo = Author(id='leo', name='Leo Tolstoy')
+    storage.save(leo)
+    books = [Book(id=str(i), title=f'Book {i}', year=1860 + i) for i in range(20)]
+    storage.save_many(books, leo)
+
+    assert storage.load(Author, 'leo') == leo
+    assert list(storage.list(Book, leo)) == sorted(books, key=lambda b: b.id)
+    assert storage.count(Book, leo) == 20
+    assert list(storage.find_by(Book, leo, year=1865)) == [books[5]]
+
+    storage.delete(Book, '5', leo)
+    storage.delete_many(Book, ['6', '7'], leo)
+    assert storage.count(Book, leo) == 17
+    assert list(storage.find_by(Book, leo, year=1865)) == []
+
+    storage.delete(Author, 'leo')
+    assert storage.count(Book, leo) == 0
+
+
+def test_reshard():
+    s = pys.file_storage('reshard.storage')
+    try:
+        leo = Author(id='leo', name='Leo Tolstoy')
+        s.save(leo)
+        books = [Book(id=f'{i:02}', title=f'Book {i}', year=1860 + i) for i in range(10)]
+        s.save_many(books, leo)
+        # Related models may be saved without the model they belong to
+        s.save(Book(id='1', title='Crime and Punishment', year=1866), (Author, 'fyodor'))
+
+        for shard_levels in (2, 1, 0):
+            s.reshard(shard_levels)
+            reopened = pys.file_storage('reshard.storage', shard_levels=shard_levels)
+            assert list(reopened.list(Author)) == [leo]
+            assert list(reopened.list(Book, leo)) == books
+            assert list(reopened.find_by(Book, leo, year=1865)) == [books[5]]
+            assert reopened.load(Book, '1', (Author, 'fyodor')).title == 'Crime and Punishment'
+    finally:
+        s.destroy()
@@ -0,0 +1,252 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import msgspec
+import pytest
+
+import pys
+
+from .conftest import Note
+
+
+@pys.saveable
+class Attachment(msgspec.Struct):
+    id: str
+    data: object
+
+
+def _count_committed(path) -> int:
+    with sqlite3.connect(path) as con:
+        if not con.execute("select count(*) from sqlite_master where name='note'").fetchone()[0]:
+            return 0
+        return con.execute('select count(*) from note').fetchone()[0]
+
+
+@pytest.fixture
+def storage():
+    s = pys.sqlite_storage('sqlite-tests.db')
+    yield s
+    s.destroy()
+
+
+def test_wal_mode(storage):
+    assert storage.con.execute('pragma journal_mode').fetchone()[0] == 'wal'
+
+
+def test_autocommit(storage):
+    storage.save(Note(id='1', text='first'))
+    assert _count_committed(storage.base_path) == 1
+
+
+def test_transaction(storage):
+    storage.save(Note(id='0', text='zero'))
+    with storage.transaction():
+        storage.save(Note(id='1', text='first'))
+        storage.save(Note(id='2', text='second'))
+        assert _count_committed(storage.base_path) == 1
+    assert _count_committed(storage.base_path) == 3
+
+    with pytest.raises(RuntimeError):
+        with storage.transaction():
+            storage.save(Note(id='3', text='third'))
+            raise RuntimeError
+    assert storage.load(Note, '3') is None
+    assert _count_committed(storage.base_path) == 3
+
+
+def test_nested_transaction(storage):
+    with storage.transaction():
+        storage.save(Note(id='1', text='first'))
+        with pytest.raises(RuntimeError):
+            with storage.transaction():
+                storage.save(Note(id='2', text='second'))
+                raise RuntimeError
+    assert storage.load(Note, '1') is not None
+    assert storage.load(Note, '2') is None
+
+
+def test_group_commit():
+    s = pys.sqlite_storage('sqlite-group.db', commit_every=3)
+    try:
+        s.save(Note(id='1', text='first'))
+        s.save(Note(id='2', text='second'))
+        assert _count_committed(s.base_path) == 0
+        s.save(Note(id='3', text='third'))
+        assert _count_committed(s.base_path) == 3
+
+        s.save(Note(id='4', text='fourth'))
+        s.commit()
+        assert _count_committed(s.base_path) == 4
+    finally:
+        s.destroy()
+
+
+def test_commit_interval_on_read():
+    s = pys.sqlite_storage('sqlite-group.db', commit_every=100, commit_interval=0.05)
+    try:
+        s.save(Note(id='1', text='first'))
+        assert _count_committed(s.base_path) == 0
+        time.sleep(0.1)
+        assert s.load(Note, '1') is not None
+        assert _count_committed(s.base_path) == 1
+    finally:
+        s.destroy()
+
+
+def test_empty_batches():
+    s = pys.sqlite_storage('sqlite-group.db', commit_every=3)
+    other = pys.sqlite_storage('sqlite-group.db', busy_timeout=0.01, retries=0)
+    try:
+        assert s.save_many([]) == []
+        s.delete_many(Note, [])
+        assert not s.con.in_transaction
+        other.save(Note(id='1', text='first'))
+    finally:
+        other.close()
+        s.destroy()
+
+
+def test_group_commit_failed_write():
+    s = pys.sqlite_storage('sqlite-group.db', commit_every=3)
+    try:
+        s.save(Note(id='1', text='first'))
+        # The related note is saved before the attachment fails to encode
+        with pytest.raises(TypeError):
+            s.save(Attachment(id='1', data=object()), Note(id='2', text='second'))
+        s.save(Note(id='3', text='third'))
+        s.commit()
+        assert [n.id for n in s.list(Note)] == ['1', '3']
+    finally:
+        s.destroy()
+
+
+def test_failed_write_in_transaction(storage):
+    with storage.transaction():
+        storage.save(Note(id='1', text='first'))
+        with pytest.raises(TypeError):
+            storage.save(Attachment(id='1', data=object()), Note(id='2', text='second'))
+        with pytest.raises(RuntimeError):
+            with storage.transaction():
+                storage.save(Note(id='3', text='third'))
+                raise RuntimeError
+    assert [n.id for n in storage.list(Note)] == ['1']
+
+
+def test_list_with_failed_write(storage):
+    storage.fetch_size = 2
+    storage.decode_batch_size = 2
+    storage.save_many([Note(id=str(i), text=str(i)) for i in range(5)])
+    notes = storage.list(Note)
+    assert next(notes).id == '0'
+    # The failed write rolls back its transaction while listing is in progress
+    with pytest.raises(TypeError):
+        storage.save(Attachment(id='1', data=object()))
+    assert [n.id for n in notes] == ['1', '2', '3', '4']
+    assert list(storage.list_ids(Note, limit=3)) == ['0', '1', '2']
+
+
+def test_schema_cache(storage):
+    storage.save(Note(id='1', text='first'))
+    storage.con.execute('drop table note')
+    storage.invalidate_schema_cache()
+    assert storage.load(Note, '1') is None
+
+    with pytest.raises(RuntimeError):
+        with storage.transaction():
+            storage.save(Note(id='2', text='second'))
+            raise RuntimeError
+    storage.save(Note(id='3', text='third'))
+    assert storage.load(Note, '3') is not None
+
+
+def test_thread_safe():
+    s = pys.sqlite_storage('sqlite-threads.db', thread_safe=True)
+    try:
+        def work(i: int) -> bool:
+            note = Note(id=str(i), text=f'Note {i}')
+            s.save(note)
+            return s.load(Note, str(i)) == note
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            assert all(executor.map(work, range(200)))
+        assert len(list(s.list(Note))) == 200
+    finally:
+        s.destroy()
+
+
+def test_thread_safe_group_commit():
+    s = pys.sqlite_storage('sqlite-threads.db', thread_safe=True, commit_every=10)
+    try:
+        def work() -> list:
+            s.save(Note(id='1', text='first'))
+            # The writing thread reads its own pending writes
+            return [s.load(Note, '1') is not None, s.exists(Note, '1'), s.count(Note), len(list(s.list(Note)))]
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            assert executor.submit(work).result() == [True, True, 1, 1]
+        # Other threads see committed data only
+        assert s.load(Note, '1') is None
+        s.commit()
+        assert s.load(Note, '1') is not None
+    finally:
+        s.destroy()
+
+
+def test_readers_closed_with_threads():
+    s = pys.sqlite_storage('sqlite-readers.db', thread_safe=True)
+    try:
+        s.save(Note(id='1', text='first'))
+        threads = [threading.Thread(target=s.load, args=(Note, '1')) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert s._readers == []
+        assert s.load(Note, '1') is not None
+    finally:
+        s.destroy()
+
+
+def test_concurrent_writers():
+    first = pys.sqlite_storage('sqlite-writers.db')
+    second = pys.sqlite_storage('sqlite-writers.db', thread_safe=True, busy_timeout=0.01, retries=20)
+    try:
+        with first.transaction():
+            first.save(Note(id='1', text='first'))
+            writer = threading.Thread(target=second.save, args=(Note(id='2', text='second'),))
+            writer.start()
+            writer.join(0.05)
+            assert writer.is_alive()
+        writer.join()
+        assert len(list(first.list(Note))) == 2
+    finally:
+        second.close()
+        first.destroy()
+
+
+def test_resave_root(storage):
+    storage.save(Note(id='1', text='first'))
+    storage.save(Note(id='1', text='updated'))
+    assert [n.text for n in storage.list(Note)] == ['updated']
+
+
+def test_duplicated_roots(storage):
+    storage.save(Note(id='1', text='first'))
+    # Root models were duplicated by older versions without the unique index
+    storage.con.execute('drop index note_root')
+    storage.con.execute("insert into note (id, data) values ('1', '{\"id\": \"1\", \"text\": \"updated\"}')")
+    storage.invalidate_schema_cache()
+    with pytest.raises(sqlite3.IntegrityError):
+        storage.load(Note, '1')
+    assert _count_committed(storage.base_path) == 2
+
+    assert storage.deduplicate(Note) == 1
+    assert [n.text for n in storage.list(Note)] == ['updated']
+
+
+def test_json_text(storage):
+    storage.save(Note(id='1', text='first'))
+    assert storage.con.execute('select typeof(data) from note').fetchone()[0] == 'text'
+    assert [n.id for n in storage.query(Note).where(text='first')] == ['1']
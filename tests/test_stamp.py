@@ -0,0 +1,97 @@
+import time
+
+import pytest
+
+import pys
+import pys.file
+
+from .conftest import Note
+
+
+exclude_backends = ('sqlite', 'log', 'dbm')
+extra_backends = {
+    'file': lambda name: pys.file_storage(f'{name}.storage', mtime_resolution=0.02),
+    'zip': lambda name: pys.zip_storage(f'{name}.zip', mtime_resolution=0.02),
+}
+
+
+def _settle(storage):
+    # Stamps of files changed within the timestamp resolution are not reliable
+    time.sleep(storage.mtime_resolution * 1.5)
+
+
+@pytest.fixture
+def storages(backend):
+    # Another instance of the same storage, as used by another process
+    (s, other) = backend('stamp'), backend('stamp')
+    yield s, other
+    s.destroy()
+
+
+def test_stamp(storages):
+    (s, other) = storages
+    s.save(Note(id='1', text='first'))
+    _settle(s)
+    stamp = s.stamp(Note, '1')
+    list_stamp = s.list_stamp(Note)
+    assert stamp is not None and stamp == s.stamp(Note, '1')
+    assert list_stamp is not None and list_stamp == s.list_stamp(Note)
+
+    other.save(Note(id='1', text='updated'))
+    _settle(s)
+    assert s.stamp(Note, '1') != stamp
+    assert s.list_stamp(Note) != list_stamp
+
+
+def test_recent_change():
+    s = pys.file_storage('recent.storage')
+    try:
+        s.save(Note(id='1', text='first'))
+        # Changed within the default resolution, it may change again without changing the stamp
+        assert s.stamp(Note, '1') is None
+    finally:
+        s.destroy()
+
+
+def test_validate(storages):
+    (s, other) = storages
+    cached = pys.cached_storage(s, validate=True, cache_lists=True)
+    other.save(Note(id='1', text='first'))
+    _settle(s)
+
+    for _ in range(3):
+        assert cached.load(Note, '1').text == 'first'
+        assert [n.text for n in cached.list(Note)] == ['first']
+        # The first reads may change the storage, e.g. create lock files
+        _settle(s)
+    hits = cached.stats.hits
+    assert hits >= 3
+
+    other.save(Note(id='1', text='updated'))
+    other.save(Note(id='2', text='second'))
+    _settle(s)
+    assert cached.load(Note, '1').text == 'updated'
+    assert [n.text for n in cached.list(Note)] == ['updated', 'second']
+    assert cached.stats.hits == hits
+
+
+def test_scan_skipped(monkeypatch):
+    s = pys.file_storage('scan.storage', mtime_resolution=0.02)
+    other = pys.file_storage('scan.storage', mtime_resolution=0.02)
+    try:
+        s.save_many([Note(id=str(i), text=f'Note {i}') for i in range(3)])
+        _settle(s)
+        scans = []
+        scandir = pys.file.os.scandir
+        monkeypatch.setattr(pys.file.os, 'scandir', lambda path: scans.append(path) or scandir(path))
+
+        assert s.count(Note) == 3
+        assert list(s.list_ids(Note)) == ['0', '1', '2']
+        assert len(scans) == 1
+
+        other.delete(Note, '1')
+        _settle(s)
+        assert list(s.list_ids(Note)) == ['0', '2']
+        assert len(scans) == 2
+    finally:
+        s.destroy()
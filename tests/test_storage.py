@@ -50,8 +50,12 @@ class BotResponse(ModelWithID, ResponseContent, Created):
 
 storages = [
     pys.file_storage('tests.storage'),
+    pys.file_storage('tests-sharded.storage', shard_levels=2),
+    pys.file_storage('tests-atomic.storage', atomic_writes=True),
     pys.sqlite_storage('tests.db'),
     pys.zip_storage('test.zip'),
+    pys.log_storage('tests.log'),
+    pys.dbm_storage('tests.dbm'),
 ]
 
 
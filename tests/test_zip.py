@@ -0,0 +1,164 @@
+import os
+import threading
+import zipfile
+
+import pytest
+from zipremove import ZipFile
+
+import pys
+
+from .conftest import Note
+
+
+@pytest.fixture
+def storage():
+    s = pys.zip_storage('session.zip')
+    yield s
+    s.destroy()
+
+
+def test_session(storage):
+    storage.save(Note(id='1', text='first'))
+    size = os.path.getsize('session.zip')
+    with storage.session():
+        storage.save(Note(id='2', text='second'))
+        storage.save(Note(id='1', text='changed'))
+        storage.delete_many(Note, ['3'])
+        # Changes are seen in the session, but the archive is written at its end
+        assert storage.load(Note, '1').text == 'changed'
+        assert [n.id for n in storage.list(Note)] == ['1', '2']
+        assert storage.count(Note) == 2
+        assert storage.exists(Note, '2')
+        storage.delete(Note, '2')
+        assert storage.load(Note, '2') is None
+        assert storage.load_many(Note, ['1', '2']) == [Note(id='1', text='changed'), None]
+        assert os.path.getsize('session.zip') == size
+
+    other = pys.zip_storage('session.zip')
+    assert [(n.id, n.text) for n in other.list(Note)] == [('1', 'changed')]
+
+
+def test_session_rollback(storage):
+    storage.save(Note(id='1', text='first'))
+    with pytest.raises(RuntimeError):
+        with storage.session():
+            storage.save(Note(id='2', text='second'))
+            storage.delete(Note, '1')
+            raise RuntimeError()
+    assert [n.id for n in storage.list(Note)] == ['1']
+
+
+def test_flush(storage):
+    with storage.session():
+        storage.save(Note(id='1', text='first'))
+        storage.flush()
+        with zipfile.ZipFile('session.zip') as archive:
+            assert archive.namelist() == ['Note/1.json']
+        storage.save(Note(id='1', text='changed'))
+    assert storage.load(Note, '1').text == 'changed'
+
+
+def test_concurrent_sessions(storage):
+    def write(prefix):
+        # Every storage object locks the archive like other processes do
+        other = pys.zip_storage('session.zip')
+        for i in range(10):
+            with other.session():
+                other.save(Note(id=f'{prefix}{i}', text=prefix))
+                other.save(Note(id=f'{prefix}{i}-copy', text=prefix))
+
+    threads = [threading.Thread(target=write, args=(prefix,)) for prefix in 'abc']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert storage.count(Note) == 60
+
+
+def test_append_only():
+    storage = pys.zip_storage('append.zip', compact_threshold=None)
+    try:
+        storage.save(Note(id='1', text='first'))
+        storage.save(Note(id='2', text='second'))
+        storage.save(Note(id='1', text='changed'))
+        storage.delete(Note, '2')
+        storage.delete(Note, '3')
+        with zipfile.ZipFile('append.zip') as archive:
+            assert archive.namelist() == ['Note/1.json', 'Note/2.json', 'Note/1.json', 'Note/2.json']
+        assert storage.load(Note, '1').text == 'changed'
+        assert storage.load(Note, '2') is None
+        assert not storage.exists(Note, '2')
+        assert [n.id for n in storage.list(Note)] == ['1']
+
+        size = os.path.getsize('append.zip')
+        storage.compact()
+        with zipfile.ZipFile('append.zip') as archive:
+            assert archive.namelist() == ['Note/1.json']
+        assert os.path.getsize('append.zip') < size
+        assert storage.load(Note, '1').text == 'changed'
+    finally:
+        storage.destroy()
+
+
+def test_compact_threshold(storage):
+    storage.save_many([Note(id=str(i), text='x' * 100) for i in range(10)])
+    for i in range(4):
+        storage.save(Note(id=str(i), text='y' * 100))
+    with zipfile.ZipFile('session.zip') as archive:
+        assert len(archive.namelist()) == 14
+    with storage.session():
+        storage.delete_many(Note, [str(i) for i in range(5)])
+    # Garbage exceeded half of the archive and was compacted
+    with zipfile.ZipFile('session.zip') as archive:
+        assert sorted(archive.namelist()) == [f'Note/{i}.json' for i in range(5, 10)]
+    assert storage.load(Note, '0') is None
+    assert storage.load(Note, '9').text == 'x' * 100
+
+
+@pytest.mark.parametrize('compression, compress_type', [
+    ('stored', zipfile.ZIP_STORED), ('deflate', zipfile.ZIP_DEFLATED),
+    ('bzip2', zipfile.ZIP_BZIP2), ('lzma', zipfile.ZIP_LZMA),
+])
+def test_compression(compression, compress_type):
+    storage = pys.zip_storage('compression.zip', compression=compression, compresslevel=None)
+    try:
+        storage.save(Note(id='1', text='first ' * 100))
+        with zipfile.ZipFile('compression.zip') as archive:
+            assert archive.getinfo('Note/1.json').compress_type == compress_type
+        # Models written with other compression are read as well
+        other = pys.zip_storage('compression.zip', compression='deflate', compresslevel=1)
+        other.save(Note(id='2', text='second'))
+        assert [n.text for n in storage.list(Note)] == ['first ' * 100, 'second']
+    finally:
+        storage.destroy()
+
+
+def test_wrong_compression():
+    with pytest.raises(ValueError):
+        pys.zip_storage('compression.zip', compression='zstd')
+
+
+def test_list_batches(storage, monkeypatch):
+    monkeypatch.setattr(storage, 'decode_batch_size', 2)
+    storage.save_many([Note(id=str(i), text=str(i)) for i in range(6)])
+    opened = []
+    monkeypatch.setattr(pys.zipfile.zipfile, 'ZipFile', lambda *args: opened.append(args) or ZipFile(*args))
+    monkeypatch.setattr(storage, 'mtime_resolution', 0)
+    notes = storage.list(Note)
+    assert [next(notes).id for _ in range(3)] == ['0', '1', '2']
+    # Listed models are read from the archive opened once, it is reopened only if it is changed
+    assert len(opened) == 1
+    other = pys.zip_storage('session.zip')
+    other.save(Note(id='4', text='changed'))
+    other.delete(Note, '5')
+    assert [(n.id, n.text) for n in notes] == [('3', '3'), ('4', 'changed')]
+
+
+def test_read_workers():
+    storage = pys.zip_storage('threads.zip', read_workers=4)
+    try:
+        storage.save_many([Note(id=f'{i:03}', text=str(i) * 1000) for i in range(300)])
+        assert [n.text for n in storage.list(Note)] == [str(i) * 1000 for i in range(300)]
+        assert storage.load_many(Note, ['001', '999']) == [Note(id='001', text='1' * 1000), None]
+    finally:
+        storage.destroy()